@@ -0,0 +1,432 @@
+import argparse
+import asyncio
+import base64
+import contextlib
+import datetime
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import httpx
+import websockets
+from jose import jwt
+from PIL import Image
+
+import protocol
+from mongo_standin import Database
+
+# hostserver and webserver under load from simulated hosts and dashboards, both on the mongo stand-in
+# usage: python benchmarks/load.py --hosts 1000 --browsers 200 --duration 60 [--output run.json] [--baseline old.json]
+# servers run as separate processes so their cpu and memory can be measured, the driver runs hosts and browsers
+
+SECRET_KEY = "benchmark"
+USERNAME = "bench"
+# what a dashboard does between two clicks, weighted
+BROWSER_MIX = {
+    "all_hosts": 1,
+    "active_hosts": 2,
+    "host_info": 2,
+    "click": 4,
+    "latest_snip": 1,
+}
+# hosts a dashboard shows in its grid, one of them is open on the control page
+GRID_SIZE = 20
+
+
+def host_ids(count):
+    # the same uuids in every process, so both stand-ins know them
+    return [str(uuid.uuid5(uuid.NAMESPACE_URL, f"bench-host-{i}")) for i in range(count)]
+
+
+def seed(count):
+    import database
+    database.db = Database()
+    now = datetime.datetime.now(datetime.UTC)
+    for host_id in host_ids(count):
+        database.db["hosts"].insert_one({"uuid": host_id, "name": "...", "lastSeen": now, "timeCreated": now})
+    database.db["users"].insert_one({"username": USERNAME, "password": USERNAME})
+
+
+def serve(args):
+    # runs in the child processes
+    seed(args.hosts)
+    with contextlib.redirect_stdout(io.StringIO()):
+        if args.serve == "hostserver":
+            import hostserver
+            asyncio.run(hostserver.main(args.hostserver_port))
+        else:
+            import uvicorn
+            import webserver
+            uvicorn.run(webserver.app, port=args.webserver_port, log_level="warning")
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def summary(latencies, errors, elapsed):
+    result = {"count": len(latencies), "errors": errors, "per_second": round(len(latencies) / elapsed, 1)}
+    if latencies:
+        result["p50_ms"] = round(percentile(latencies, 50) * 1000, 2)
+        result["p99_ms"] = round(percentile(latencies, 99) * 1000, 2)
+    return result
+
+
+def process_stats(pid):
+    # cpu seconds and resident memory from /proc, None where there is no /proc
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/status") as f:
+            status = dict(_.split(":", 1) for _ in f if ":" in _)
+    except OSError:
+        return None
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    return {"cpu_seconds": cpu, "rss_mb": int(status["VmRSS"].split()[0]) / 1024,
+            "peak_rss_mb": int(status["VmHWM"].split()[0]) / 1024}
+
+
+def png(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class Frames:
+    # synthetic screens, a flat desktop with noise where windows would be
+    # noise compresses about as badly as busy window content, changed tiles are all noise
+    def __init__(self, width, height, tiles, busy):
+        self.size = (width, height)
+        self.tiles = tiles
+        noise = [Image.effect_noise((protocol.TILE_SIZE, protocol.TILE_SIZE), 64).convert("RGB") for _ in range(16)]
+        self.noise = [png(_) for _ in noise]
+        screen = Image.new("RGB", self.size, (32, 64, 96))
+        for y in range(0, height, protocol.TILE_SIZE):
+            for x in range(0, width, protocol.TILE_SIZE):
+                if random.random() < busy:
+                    screen.paste(random.choice(noise), (x, y))
+        self.keyframe = png(screen)
+
+    def key(self):
+        return protocol.pack_snip(True, self.size, [(0, 0, self.keyframe)])
+
+    def delta(self):
+        tiles = []
+        for _ in range(self.tiles):
+            x = random.randrange(0, self.size[0], protocol.TILE_SIZE)
+            y = random.randrange(0, self.size[1], protocol.TILE_SIZE)
+            tiles.append((x, y, random.choice(self.noise)))
+        return protocol.pack_snip(False, self.size, tiles)
+
+
+async def simulated_host(url, host_id, frames, stats, stop):
+    # speaks the protocol host.py speaks, without a screen or a mouse
+    start = time.perf_counter()
+    async with websockets.connect(url, max_size=100 * 1024 * 1024) as websocket:
+        packet = dict()
+        packet["type"] = "hello"
+        packet["host_id"] = host_id
+        packet["rates"] = True
+        await websocket.send(json.dumps(packet))
+        await websocket.recv()
+        stats["hello"].append(time.perf_counter() - start)
+        interval = [protocol.IDLE_INTERVAL]
+        rate_changed = asyncio.Event()
+
+        async def heartbeat():
+            packet = dict()
+            packet["type"] = "heartbeat"
+            # spread out so a thousand hosts do not beat in lockstep
+            await asyncio.sleep(random.uniform(0, 5))
+            while True:
+                await websocket.send(json.dumps(packet))
+                await asyncio.sleep(5)
+
+        async def capture():
+            await websocket.send(frames.key())
+            while True:
+                rate_changed.clear()
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(rate_changed.wait(), interval[0])
+                await websocket.send(frames.delta())
+                stats["frames"] += 1
+
+        async def listen():
+            async for message in websocket:
+                data = json.loads(message)
+                if data["type"] == "rate":
+                    interval[0] = data["interval"]
+                    rate_changed.set()
+                elif data["type"] == "snip":
+                    if data.get("request_id"):
+                        data["data"] = base64.b64encode(frames.keyframe).decode("ascii")
+                        await websocket.send(json.dumps(data))
+                    else:
+                        await websocket.send(frames.key())
+                elif data["type"] == "command":
+                    output = {"type": "output", "request_id": data["request_id"], "stream": "out", "data": "ok\n"}
+                    await websocket.send(json.dumps(output))
+                    data.update(out="", err="", code=0, status="exited")
+                    await websocket.send(json.dumps(data))
+                elif data["type"] == "input":
+                    packet = {"type": "input", "channel": data["channel"], "ack": data["seq"] + len(data["events"]) - 1}
+                    await websocket.send(json.dumps(packet))
+                else:
+                    # click, move, write, hotkey, run are acked by echoing them
+                    await websocket.send(json.dumps(data))
+
+        tasks = [asyncio.create_task(_) for _ in (heartbeat(), capture(), listen())]
+        await stop.wait()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def simulated_browser(base, cookie, hosts, think, stats, stop):
+    # a dashboard: a live socket watching a grid of hosts, and api calls against hosts of that grid
+    grid = random.sample(hosts, min(GRID_SIZE, len(hosts)))
+    headers = {"Cookie": f"access_token={cookie}"}
+    async with httpx.AsyncClient(base_url=base, headers=headers, timeout=60) as client:
+        async with websockets.connect(base.replace("http", "ws") + "/api/live", additional_headers=headers) as live:
+            await live.send(json.dumps({"type": "watch", "hosts": grid, "level": "grid"}))
+
+            async def events():
+                async for _ in live:
+                    stats["events"] += 1
+
+            events_task = asyncio.create_task(events())
+            requests = list(BROWSER_MIX)
+            weights = list(BROWSER_MIX.values())
+            await asyncio.sleep(random.uniform(0, think))
+            while not stop.is_set():
+                name = random.choices(requests, weights)[0]
+                host_id = random.choice(grid)
+                start = time.perf_counter()
+                try:
+                    if name == "click":
+                        form = {"cmd": "click", "x": "-1", "y": "-1", "button": "left", "clicks": "1"}
+                        response = await client.post(f"/host/{host_id}/submit", data=form)
+                    elif name == "host_info":
+                        response = await client.get(f"/api/host_info/{host_id}")
+                    elif name == "latest_snip":
+                        response = await client.get(f"/api/latest_snip/{host_id}/s")
+                    else:
+                        response = await client.get(f"/api/{name}")
+                    # a host without a frame yet answers 404 for its snip, that is not a failure of the server
+                    ok = response.status_code < 400 or (name == "latest_snip" and response.status_code == 404)
+                except httpx.HTTPError:
+                    ok = False
+                if ok:
+                    stats["requests"][name].append(time.perf_counter() - start)
+                else:
+                    stats["errors"][name] = stats["errors"].get(name, 0) + 1
+                await asyncio.sleep(random.expovariate(1 / think))
+            events_task.cancel()
+            await asyncio.gather(events_task, return_exceptions=True)
+
+
+async def read_line():
+    return await asyncio.get_running_loop().run_in_executor(None, sys.stdin.readline)
+
+
+def report_line(packet):
+    # workers talk to the driver over stdout, one json object per line
+    sys.stdout.write(json.dumps(packet) + "\n")
+    sys.stdout.flush()
+
+
+async def simulate(args):
+    # one worker: connects its share of hosts, says ready, runs its share of browsers on "go" until "stop"
+    hosts = host_ids(args.hosts)
+    mine = hosts[args.worker::args.workers]
+    browsers = len(range(args.worker, args.browsers, args.workers))
+    frames = Frames(args.width, args.height, args.tiles, args.busy)
+    stats = {"hello": [], "frames": 0, "events": 0, "requests": {_: [] for _ in BROWSER_MIX}, "errors": dict()}
+    stop = asyncio.Event()
+
+    start = time.perf_counter()
+    url = f"ws://localhost:{args.hostserver_port}"
+    host_tasks = [asyncio.create_task(simulated_host(url, _, frames, stats, stop)) for _ in mine]
+    while len(stats["hello"]) < len(mine) and not any(task.done() for task in host_tasks):
+        await asyncio.sleep(0.05)
+    report_line({"connect_seconds": time.perf_counter() - start})
+
+    await read_line()
+    base = f"http://localhost:{args.webserver_port}"
+    cookie = "Bearer " + jwt.encode({"sub": USERNAME}, SECRET_KEY, algorithm="HS256")
+    browser_tasks = [asyncio.create_task(simulated_browser(base, cookie, hosts, args.think, stats, stop))
+                     for _ in range(browsers)]
+    await read_line()
+    stop.set()
+    results = await asyncio.gather(*host_tasks, *browser_tasks, return_exceptions=True)
+    stats["failures"] = [repr(_) for _ in results if isinstance(_, Exception)]
+    report_line(stats)
+
+
+def loop_lag(url):
+    # mean event loop lag from a /metrics endpoint
+    try:
+        text = httpx.get(url).text
+    except httpx.HTTPError:
+        return None
+    values = dict(_.rsplit(" ", 1) for _ in text.splitlines() if _.startswith("event_loop_lag_seconds_"))
+    count = float(values.get("event_loop_lag_seconds_count", 0))
+    return round(float(values["event_loop_lag_seconds_sum"]) / count * 1000, 2) if count else None
+
+
+def wait_for_port(url):
+    for _ in range(100):
+        try:
+            httpx.get(url)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up")
+
+
+def drive(args, servers, command, env):
+    wait_for_port(f"http://localhost:{args.hostserver_port}/metrics")
+    wait_for_port(f"http://localhost:{args.webserver_port}/metrics")
+
+    workers = [subprocess.Popen(command + ["--worker", str(i)], env=env, text=True,
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE) for i in range(args.workers)]
+    connect_seconds = max(json.loads(_.stdout.readline())["connect_seconds"] for _ in workers)
+    # webserver learns about the hosts from online events
+    time.sleep(1)
+
+    for worker in workers:
+        worker.stdin.write("go\n")
+        worker.stdin.flush()
+    start = time.perf_counter()
+    before = {name: process_stats(process.pid) for name, process in servers.items()}
+    samples = []
+    while time.perf_counter() - start < args.duration:
+        time.sleep(1)
+        samples.append({name: process_stats(process.pid) for name, process in servers.items()})
+    elapsed = time.perf_counter() - start
+    lag = {"hostserver": loop_lag(f"http://localhost:{args.hostserver_port}/metrics"),
+           "webserver": loop_lag(f"http://localhost:{args.webserver_port}/metrics")}
+
+    for worker in workers:
+        worker.stdin.write("stop\n")
+        worker.stdin.flush()
+    stats = {"hello": [], "frames": 0, "events": 0, "requests": {_: [] for _ in BROWSER_MIX}, "errors": dict(),
+             "failures": []}
+    for worker in workers:
+        result = json.loads(worker.stdout.readline())
+        worker.wait()
+        for key in ("hello", "failures"):
+            stats[key].extend(result[key])
+        for key in ("frames", "events"):
+            stats[key] += result[key]
+        for name in BROWSER_MIX:
+            stats["requests"][name].extend(result["requests"][name])
+            stats["errors"][name] = stats["errors"].get(name, 0) + result["errors"].get(name, 0)
+
+    report = {
+        "hosts": args.hosts,
+        "browsers": args.browsers,
+        "workers": args.workers,
+        "duration": round(elapsed, 1),
+        "hello": summary(stats["hello"], args.hosts - len(stats["hello"]), connect_seconds),
+        "requests": {name: summary(values, stats["errors"][name], elapsed)
+                     for name, values in stats["requests"].items()},
+        "frames_per_second": round(stats["frames"] / elapsed, 1),
+        "events_per_second": round(stats["events"] / elapsed, 1),
+        "client_failures": len(stats["failures"]),
+        "servers": dict(),
+    }
+    for name in servers:
+        if before[name] is None or not samples:
+            continue
+        report["servers"][name] = {
+            "cpu_percent": round((samples[-1][name]["cpu_seconds"] - before[name]["cpu_seconds"]) / elapsed * 100, 1),
+            "rss_mb": round(max(_[name]["rss_mb"] for _ in samples), 1),
+            "peak_rss_mb": round(samples[-1][name]["peak_rss_mb"], 1),
+            "loop_lag_ms": lag[name],
+        }
+    if stats["failures"]:
+        report["first_failure"] = stats["failures"][0]
+    return report
+
+
+def compare(report, baseline, path=""):
+    # relative change of every number that is in both runs
+    changes = dict()
+    for key, value in report.items():
+        old = baseline.get(key) if isinstance(baseline, dict) else None
+        if isinstance(value, dict) and isinstance(old, dict):
+            changes.update(compare(value, old, f"{path}{key}."))
+        elif isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+            changes[f"{path}{key}"] = f"{(value - old) / old * 100:+.1f}%"
+    return changes
+
+
+def main(args):
+    workdir = tempfile.mkdtemp(prefix="berd-load-")
+    # snips are written under data/, the webserver needs its templates and static files
+    for name in ("static", "templates"):
+        os.symlink(os.path.join(ROOT, name), os.path.join(workdir, name))
+    env = dict(os.environ)
+    env["SECRET_KEY"] = SECRET_KEY
+    env["HOSTSERVER_NODES"] = f"ws://localhost:{args.hostserver_port}"
+    env["HOSTSERVER_URL"] = env["HOSTSERVER_NODES"]
+    env.pop("METRICS_TOKEN", None)
+    command = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:]
+    servers = dict()
+    try:
+        for name in ("hostserver", "webserver"):
+            servers[name] = subprocess.Popen(command + ["--serve", name], cwd=workdir, env=env)
+        report = drive(args, servers, command, env)
+    finally:
+        for process in servers.values():
+            process.terminate()
+            process.wait()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["change"] = compare(report, json.load(f))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({_: report[_] for _ in report if _ != "change"}, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hosts", type=int, default=1000)
+    parser.add_argument("--browsers", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=60)
+    # processes simulating hosts and browsers, one python process can not keep up with a thousand hosts
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    # mean seconds a dashboard waits between two requests
+    parser.add_argument("--think", type=float, default=1.0)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    # changed tiles per delta frame
+    parser.add_argument("--tiles", type=int, default=8)
+    # share of the screen covered by busy content in keyframes
+    parser.add_argument("--busy", type=float, default=0.1)
+    parser.add_argument("--hostserver-port", type=int, default=8798)
+    parser.add_argument("--webserver-port", type=int, default=8797)
+    parser.add_argument("--output")
+    parser.add_argument("--baseline")
+    parser.add_argument("--serve", choices=["hostserver", "webserver"], help=argparse.SUPPRESS)
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args)
+    elif args.worker is not None:
+        asyncio.run(simulate(args))
+    else:
+        main(args)
@@ -0,0 +1,107 @@
+import copy
+
+from pymongo.errors import DuplicateKeyError
+
+
+# in memory stand-in for the parts of pymongo used by the servers
+# counts the documents every query has to look at so benchmarks can report it
+
+
+def matches(document, query):
+    for key, value in query.items():
+        if key == "$or":
+            if not any(matches(document, _) for _ in value):
+                return False
+        elif document.get(key) != value:
+            return False
+    return True
+
+
+def project(document, projection):
+    if not projection:
+        return copy.deepcopy(document)
+    fields = [key for key, value in projection.items() if value and key != "_id"]
+    if not fields:
+        return {key: copy.deepcopy(value) for key, value in document.items() if projection.get(key, 1)}
+    return {key: copy.deepcopy(document[key]) for key in fields if key in document}
+
+
+class Cursor(list):
+    def close(self):
+        pass
+
+
+class Collection:
+    def __init__(self):
+        self.documents = []
+        # field -> {value: document} for fields with an index
+        self.indexes = dict()
+        self.unique = set()
+        self.scanned = 0
+        self.queries = 0
+
+    def create_index(self, key, unique=False):
+        self.indexes[key] = {_[key]: _ for _ in self.documents if key in _}
+        if unique:
+            self.unique.add(key)
+        return f"{key}_1"
+
+    def candidates(self, query):
+        self.queries += 1
+        # single field equality on an indexed field does not scan
+        if len(query) == 1:
+            key, value = next(iter(query.items()))
+            if key in self.indexes and not isinstance(value, dict):
+                self.scanned += 1
+                document = self.indexes[key].get(value)
+                return [document] if document else []
+        self.scanned += len(self.documents)
+        return [_ for _ in self.documents if matches(_, query)]
+
+    def find(self, query=None, projection=None):
+        return Cursor(project(_, projection) for _ in self.candidates(query or {}))
+
+    def find_one(self, query=None, projection=None):
+        found = self.candidates(query or {})
+        return project(found[0], projection) if found else None
+
+    def insert_one(self, document):
+        for key in self.unique:
+            if document.get(key) in self.indexes[key]:
+                raise DuplicateKeyError(f"duplicate key {key}")
+        document = copy.deepcopy(document)
+        self.documents.append(document)
+        for key, index in self.indexes.items():
+            if key in document:
+                index[document[key]] = document
+
+    def update_one(self, query, update):
+        found = self.candidates(query)
+        if found:
+            found[0].update(copy.deepcopy(update.get("$set", {})))
+
+    def find_one_and_update(self, query, update):
+        found = self.candidates(query)
+        if found:
+            before = copy.deepcopy(found[0])
+            found[0].update(copy.deepcopy(update.get("$set", {})))
+            return before
+        return None
+
+    def bulk_write(self, requests, ordered=True):
+        # only UpdateOne is used by the servers
+        for request in requests:
+            self.update_one(request._filter, request._doc)
+
+    def delete_one(self, query):
+        found = self.candidates(query)
+        if found:
+            self.documents.remove(found[0])
+            for key, index in self.indexes.items():
+                index.pop(found[0].get(key), None)
+
+
+class Database(dict):
+    def __missing__(self, name):
+        self[name] = Collection()
+        return self[name]
@@ -0,0 +1,95 @@
+import argparse
+import asyncio
+import contextlib
+import datetime
+import io
+import json
+import os
+import sys
+import time
+from uuid import uuid4
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import websockets
+
+import database
+import hostserver
+from mongo_standin import Database
+
+# simulates every registered host reconnecting at once after a hostserver restart
+# usage: python benchmarks/reconnect_storm.py --hosts 1000 [--legacy]
+
+
+async def legacy_is_known_host(host_id):
+    # what hello did before the registry, load every uuid and search the list
+    res = await database.find("hosts", {}, {"_id": 0, "uuid": 1})
+    uuids = [_["uuid"] for _ in res]
+    return host_id in uuids
+
+
+async def reconnect(url, host_id, latencies, ready):
+    start = time.perf_counter()
+    async with websockets.connect(url) as websocket:
+        packet = dict()
+        packet["type"] = "hello"
+        packet["host_id"] = host_id
+        await websocket.send(json.dumps(packet))
+        await websocket.recv()
+        latencies.append(time.perf_counter() - start)
+        # stay connected until the whole storm has landed
+        await ready.wait()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def main(args):
+    database.db = Database()
+    now = datetime.datetime.now(datetime.UTC)
+    host_ids = [str(uuid4()) for _ in range(args.hosts)]
+    for host_id in host_ids:
+        database.db["hosts"].insert_one({"uuid": host_id, "name": "...", "lastSeen": now, "timeCreated": now})
+
+    if args.legacy:
+        hostserver.is_known_host = legacy_is_known_host
+    else:
+        await hostserver.load_known_hosts()
+    collection = database.db["hosts"]
+    collection.scanned = collection.queries = 0
+
+    latencies = []
+    ready = asyncio.Event()
+    async with websockets.serve(hostserver.handler, "localhost", args.port):
+        start = time.perf_counter()
+        tasks = [asyncio.create_task(reconnect(f"ws://localhost:{args.port}", _, latencies, ready)) for _ in host_ids]
+        while len(latencies) < len(host_ids):
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - start
+        ready.set()
+        await asyncio.gather(*tasks)
+
+    return {
+        "mode": "legacy" if args.legacy else "registry",
+        "hosts": args.hosts,
+        "seconds": round(elapsed, 3),
+        "hellos_per_second": round(args.hosts / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "db_queries": collection.queries,
+        "documents_scanned": collection.scanned,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hosts", type=int, default=1000)
+    parser.add_argument("--port", type=int, default=8799)
+    parser.add_argument("--legacy", action="store_true")
+    args = parser.parse_args()
+    # hostserver prints on every connect
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = asyncio.run(main(args))
+    print(json.dumps(result, indent=2))
@@ -0,0 +1,124 @@
+import asyncio
+import hashlib
+import os
+import time
+import zlib
+from collections import OrderedDict
+from uuid import uuid4
+
+from websockets import ConnectionClosed
+
+import protocol
+
+# uploads are stored once under the sha256 of their content, however many hosts they go to
+# webserver writes them, hostserver streams them, both run from the same directory
+BLOB_DIR = "blobs"
+# blobs nobody uploaded again for this many seconds are removed
+BLOB_MAX_AGE = 7 * 24 * 3600
+# seconds between sweeps for old blobs
+BLOB_PRUNE_INTERVAL = 3600
+# bytes of chunks kept in memory, a file pushed to a group is read from disk once
+CHUNK_CACHE_SIZE = 256 * 1024 * 1024
+
+# (sha256, offset) -> (data, crc32), least recently used first
+chunks = OrderedDict()
+cached_bytes = 0
+
+
+def blob_path(digest):
+    return os.path.join(BLOB_DIR, digest)
+
+
+def is_digest(digest):
+    return isinstance(digest, str) and len(digest) == 64 and all(_ in "0123456789abcdef" for _ in digest)
+
+
+class BlobWriter:
+    # hashes a file while it is written, then files it under its hash
+    # an upload that is already stored is dropped and the stored copy kept
+
+    def __init__(self):
+        os.makedirs(BLOB_DIR, exist_ok=True)
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.temppath = os.path.join(BLOB_DIR, f".{uuid4()}.part")
+        self.file = open(self.temppath, "wb")
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        self.file.write(data)
+
+    def commit(self):
+        self.file.close()
+        digest = self.hash.hexdigest()
+        if os.path.exists(blob_path(digest)):
+            os.remove(self.temppath)
+            # uploaded again, keep it around for another BLOB_MAX_AGE
+            os.utime(blob_path(digest))
+        else:
+            os.replace(self.temppath, blob_path(digest))
+        return digest
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.temppath)
+
+
+def prune(max_age=BLOB_MAX_AGE):
+    # scans the whole directory, run it in a thread
+    if not os.path.isdir(BLOB_DIR):
+        return
+    cutoff = time.time() - max_age
+    for entry in os.scandir(BLOB_DIR):
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+def load_chunk(digest, offset):
+    # runs in a thread, the cache is only touched on the loop
+    with open(blob_path(digest), "rb") as f:
+        f.seek(offset)
+        data = f.read(protocol.CHUNK_SIZE)
+    return data, zlib.crc32(data)
+
+
+async def read_chunk(digest, offset):
+    # a chunk and its checksum, read and computed once for every host it is sent to
+    global cached_bytes
+    key = (digest, offset)
+    chunk = chunks.get(key)
+    if chunk is not None:
+        chunks.move_to_end(key)
+        return chunk
+
+    chunk = await asyncio.to_thread(load_chunk, digest, offset)
+    if key in chunks:
+        # read by another host's transfer meanwhile
+        return chunks[key]
+    chunks[key] = chunk
+    cached_bytes += len(chunk[0])
+    while cached_bytes > CHUNK_CACHE_SIZE:
+        _, (evicted, _) = chunks.popitem(last=False)
+        cached_bytes -= len(evicted)
+    return chunk
+
+
+async def send_blob(websocket, request_id, digest, offset=0):
+    # like protocol.send_file, only the chunk header is built per host
+    # returns True once the last chunk has been sent
+    try:
+        size = os.path.getsize(blob_path(digest))
+        while True:
+            data, crc = await read_chunk(digest, offset)
+            last = offset + len(data) >= size
+            await websocket.send(protocol.pack_chunk(request_id, offset, data, last, crc))
+            offset += len(data)
+            if last:
+                return True
+    except ConnectionClosed:
+        # the receiver resumes from its own offset after reconnecting
+        return False
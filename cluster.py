@@ -0,0 +1,35 @@
+import bisect
+import hashlib
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# every hostserver node, comma separated, hosts are spread over them by consistent hashing
+# with a single node everything behaves like one standalone hostserver
+NODES = [_.strip() for _ in os.getenv("HOSTSERVER_NODES", "ws://localhost:8765").split(",") if _.strip()]
+# points per node on the ring, more points spread hosts more evenly
+REPLICAS = 100
+
+
+def position(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class Ring:
+    # a host belongs to the first node point at or after its own position on the ring
+    # adding or removing a node only moves the hosts next to that node's points
+
+    def __init__(self, nodes, replicas=REPLICAS):
+        self.nodes = list(nodes)
+        points = sorted((position(f"{node}#{i}"), node) for node in self.nodes for i in range(replicas))
+        self.positions = [_[0] for _ in points]
+        self.owners = [_[1] for _ in points]
+
+    def node_for(self, host_id):
+        index = bisect.bisect(self.positions, position(host_id)) % len(self.positions)
+        return self.owners[index]
+
+
+ring = Ring(NODES)
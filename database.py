@@ -0,0 +1,91 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pymongo
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv()
+
+# pymongo is synchronous, so every call runs on this pool and the event loop never waits on mongo
+# one thread per pooled connection, more threads would only queue inside the driver
+POOL_SIZE = int(os.getenv("MONGO_POOL_SIZE", 16))
+
+client = pymongo.MongoClient(
+    os.getenv("CONN_STRING"),
+    maxPoolSize=POOL_SIZE,
+    # keep a couple of connections warm so the first request after idle does not pay the handshake
+    minPoolSize=2,
+    maxIdleTimeMS=60 * 1000,
+    # fail fast instead of piling up requests when mongo is unreachable
+    waitQueueTimeoutMS=5 * 1000,
+    serverSelectionTimeoutMS=5 * 1000,
+    connectTimeoutMS=5 * 1000,
+)
+db = client["remote"]
+executor = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix="mongo")
+
+mongo_seconds = metrics.Histogram("mongo_call_seconds", "Mongo calls, including the wait for a pool thread")
+mongo_errors = metrics.Counter("mongo_errors_total", "Mongo calls that raised")
+mongo_inflight = metrics.Gauge("mongo_inflight", "Mongo calls running or waiting for a pool thread")
+
+
+async def run(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
+async def call(op, func):
+    # every helper below goes through here, so latency is known per kind of call
+    mongo_inflight.inc()
+    try:
+        with mongo_seconds.time(op=op):
+            return await run(func)
+    except pymongo.errors.PyMongoError:
+        mongo_errors.inc(op=op)
+        raise
+    finally:
+        mongo_inflight.inc(-1)
+
+
+async def find(collection, query=None, projection=None):
+    # cursor is drained on the pool, iterating it on the loop would block once per batch
+    def fetch():
+        res = db[collection].find(query or {}, projection)
+        try:
+            return list(res)
+        finally:
+            res.close()
+
+    return await call("find", fetch)
+
+
+async def find_one(collection, query, projection=None):
+    return await call("find_one", lambda: db[collection].find_one(query, projection))
+
+
+async def insert_one(collection, document):
+    return await call("insert_one", lambda: db[collection].insert_one(document))
+
+
+async def update_one(collection, query, update):
+    return await call("update_one", lambda: db[collection].update_one(query, update))
+
+
+async def find_one_and_update(collection, query, update):
+    return await call("find_one_and_update", lambda: db[collection].find_one_and_update(query, update))
+
+
+async def delete_one(collection, query):
+    return await call("delete_one", lambda: db[collection].delete_one(query))
+
+
+async def create_index(collection, key, **kwargs):
+    return await call("create_index", lambda: db[collection].create_index(key, **kwargs))
+
+
+async def bulk_write(collection, requests, ordered=True):
+    return await call("bulk_write", lambda: db[collection].bulk_write(requests, ordered=ordered))
@@ -1,20 +1,105 @@
 import asyncio
 import base64
+import codecs
+import hashlib
+import io
 import json
 import os
-import subprocess
+import shutil
+import signal
+from concurrent.futures import ThreadPoolExecutor
 
 import pyautogui
+from PIL import ImageChops
 
 import websockets
 from websockets import ConnectionClosed, ConnectionClosedError
 
+import metrics
+import protocol
+
 # server uses uuid to differentiate between hosts, stored in config.json
 CONFIG = {'host_id': ''}
 
 # DO NOT FORGET TO CHANGE THIS DURING DEPLOYMENT
 IP = "ws://localhost:8765"
 
+# send the screen as binary frames carrying only the tiles that changed
+# instead of a full base64 png on every snip
+STREAM = True
+
+# last frame sent to host server, deltas are computed against it
+last_frame = None
+
+# seconds between frames, host server shortens it while someone is watching this host
+capture_interval = protocol.IDLE_INTERVAL
+# set when host server changes the interval, so a new viewer does not wait out the old one
+rate_changed = asyncio.Event()
+
+# input channel -> sequence number of the last event applied, anything at or below it is a repeat
+input_seqs = dict()
+
+# pyautogui blocks, typewrite sleeps between characters, none of it may run on the event loop
+# a single input thread plays events back in the order they arrived
+input_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="input")
+# screenshots have their own thread so frames keep flowing while input is played back
+capture_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="capture")
+# tasks waiting for input to be played back before acking it
+acks = set()
+
+# commands running at once, more wait for a free slot
+COMMAND_CONCURRENCY = 4
+# seconds a command may run before it is killed, webserver may ask for less
+COMMAND_TIMEOUT = 300
+# bytes of output read and sent at a time
+OUTPUT_CHUNK_SIZE = 16 * 1024
+command_slots = asyncio.Semaphore(COMMAND_CONCURRENCY)
+# request_id -> task running that command, so it can be cancelled
+commands = dict()
+
+# metrics of this host are written here every STATS_INTERVAL seconds, in the prometheus text format
+STATS_FILE = "stats.txt"
+STATS_INTERVAL = 60
+
+packets_received = metrics.Counter("host_packets_total", "Packets received from host server, by type")
+capture_seconds = metrics.Histogram("host_capture_seconds", "Taking and encoding a frame")
+frame_bytes = metrics.Histogram("host_frame_bytes", "Size of frames sent, by kind", metrics.SIZE_BUCKETS)
+input_seconds = metrics.Histogram("host_input_seconds", "From receiving input to having played it back")
+commands_finished = metrics.Counter("host_commands_total", "Shell commands finished, by status")
+reconnects = metrics.Counter("host_reconnects_total", "Connections to host server lost")
+metrics.Gauge("host_input_queued", "Input packets waiting to be played back", lambda: len(acks))
+metrics.Gauge("host_commands_running", "Shell commands running or waiting for a slot", lambda: len(commands))
+
+# file transfers in progress, kept across reconnects so they can resume
+# request_id -> {"type": "upload" or "download", "filename": ..., "offset": ...}
+transfers = dict()
+# request_id -> task streaming a file to host server
+streams = dict()
+# path in downloads -> (size, mtime, sha256), so a file is only hashed again once it changes
+file_hashes = dict()
+
+
+def encode_tiles(image, previous):
+    # keyframes are sent as a single tile covering the whole screen
+    if previous is None:
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        return [(0, 0, buffer.getvalue())]
+
+    width, height = image.size
+    diff = ImageChops.difference(image, previous)
+    tiles = []
+    for y in range(0, height, protocol.TILE_SIZE):
+        for x in range(0, width, protocol.TILE_SIZE):
+            box = (x, y, min(x + protocol.TILE_SIZE, width), min(y + protocol.TILE_SIZE, height))
+            # getbbox is None when every pixel of the tile is unchanged
+            if not diff.crop(box).getbbox():
+                continue
+            buffer = io.BytesIO()
+            image.crop(box).save(buffer, format="PNG")
+            tiles.append((x, y, buffer.getvalue()))
+    return tiles
+
 
 async def on_ready(websocket: websockets.ClientConnection):
     print("Loading configuration")
@@ -50,12 +135,74 @@ async def hello(websocket: websockets.ClientConnection):
     print(f"Authorizing with UUID: {CONFIG['host_id']}")
     packet['type'] = "hello"
     packet['host_id'] = CONFIG['host_id']
+    # frames are sent at the rate host server asks for instead of on every heartbeat
+    packet['rates'] = STREAM
     await websocket.send(json.dumps(packet))
     async for message in websocket:
         print(message)
+        # a hostserver node that does not own this host points to the one that does
+        if message.startswith("{"):
+            return json.loads(message).get("url")
         break
 
 
+def part_path(request_id):
+    # uploads are written here until the last chunk arrives
+    return os.path.join("downloads", f".{request_id}.part")
+
+
+def transfer_packet(request_id):
+    # tells host server where to continue a transfer from
+    transfer = transfers[request_id]
+    packet = dict()
+    packet["type"] = transfer["type"]
+    packet["request_id"] = request_id
+    packet["filename"] = transfer["filename"]
+    if transfer["type"] == "upload":
+        packet["offset"] = transfer["offset"]
+        if transfer.get("sha256"):
+            packet["sha256"] = transfer["sha256"]
+    else:
+        # host server knows how much of a download it has, ask it
+        packet["resume"] = True
+    return packet
+
+
+def file_hash(path):
+    stat = os.stat(path)
+    cached = file_hashes.get(path)
+    if cached and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+        return cached[2]
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while data := f.read(protocol.CHUNK_SIZE):
+            digest.update(data)
+    file_hashes[path] = (stat.st_size, stat.st_mtime_ns, digest.hexdigest())
+    return file_hashes[path][2]
+
+
+def place_download(digest, size, filename):
+    # puts a file with this content in downloads under filename without a transfer
+    # only files of the same size are hashed, returns False if none has the content
+    target = os.path.join("downloads", filename)
+    for entry in os.scandir("downloads"):
+        if entry.name.startswith(".") or not entry.is_file() or entry.stat().st_size != size:
+            continue
+        if file_hash(entry.path) != digest:
+            continue
+        if entry.path != target:
+            shutil.copyfile(entry.path, target)
+        return True
+    return False
+
+
+async def resume_transfers(websocket: websockets.ClientConnection):
+    # pick up transfers that were interrupted by a lost connection
+    for request_id in list(transfers.keys()):
+        print(f"Resuming {transfers[request_id]['type']} of {transfers[request_id]['filename']}")
+        await websocket.send(json.dumps(transfer_packet(request_id)))
+
+
 async def heartbeat(websocket: websockets.ClientConnection):
     # heartbeat packet is sent every 5 seconds
     # server uses this for last seen
@@ -67,53 +214,301 @@ async def heartbeat(websocket: websockets.ClientConnection):
         await asyncio.sleep(5)
 
 
+def grab_frame(keyframe):
+    # runs on the capture thread, the only one touching last_frame
+    global last_frame
+    image = pyautogui.screenshot()
+    keyframe = keyframe or last_frame is None or last_frame.size != image.size
+    tiles = encode_tiles(image, None if keyframe else last_frame)
+    last_frame = image
+    if not keyframe and not tiles:
+        # screen has not changed since the last frame
+        return None
+    return protocol.pack_snip(keyframe, image.size, tiles)
+
+
+def grab_png():
+    buffer = io.BytesIO()
+    pyautogui.screenshot().save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+async def send_frame(websocket: websockets.ClientConnection, keyframe=False):
+    with capture_seconds.time():
+        frame = await asyncio.get_running_loop().run_in_executor(capture_executor, grab_frame, keyframe)
+    if frame is not None:
+        frame_bytes.observe(len(frame), kind="keyframe" if frame[1] else "delta")
+        await websocket.send(frame)
+
+
+async def capture(websocket: websockets.ClientConnection):
+    while True:
+        await send_frame(websocket)
+        rate_changed.clear()
+        try:
+            await asyncio.wait_for(rate_changed.wait(), capture_interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def send_output(websocket: websockets.ClientConnection, request_id, name, reader):
+    # output is sent as it is produced, webserver does not wait for the whole command
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    while True:
+        data = await reader.read(OUTPUT_CHUNK_SIZE)
+        # a character split between two reads is decoded with the second one
+        text = decoder.decode(data, final=not data)
+        if text:
+            packet = dict()
+            packet["type"] = "output"
+            packet["request_id"] = request_id
+            packet["stream"] = name
+            packet["data"] = text
+            await websocket.send(json.dumps(packet))
+        if not data:
+            return
+
+
+def kill_process(process):
+    if os.name == "nt":
+        process.kill()
+    else:
+        # the shell's children are in its process group
+        os.killpg(process.pid, signal.SIGKILL)
+
+
+async def run_command(websocket: websockets.ClientConnection, data):
+    packet = dict(data)
+    packet["out"] = packet["err"] = ""
+    timeout = min(float(data.get("timeout", COMMAND_TIMEOUT)), COMMAND_TIMEOUT)
+    try:
+        await command_slots.acquire()
+    except asyncio.CancelledError:
+        # cancelled while waiting for a slot, it never ran
+        packet["status"], packet["code"] = "cancelled", None
+        commands_finished.inc(status="cancelled")
+        try:
+            await websocket.send(json.dumps(packet))
+        except ConnectionClosed:
+            pass
+        return
+    process = None
+    try:
+        try:
+            process = await asyncio.create_subprocess_shell(data["command"], stdout=asyncio.subprocess.PIPE,
+                                                            stderr=asyncio.subprocess.PIPE,
+                                                            start_new_session=os.name != "nt")
+        except OSError as e:
+            # the shell could not be started, there is no exit code
+            packet["status"], packet["err"] = "error", str(e)
+        except asyncio.CancelledError:
+            packet["status"] = "cancelled"
+        if process is not None:
+            try:
+                async with asyncio.timeout(timeout):
+                    await asyncio.gather(send_output(websocket, data["request_id"], "out", process.stdout),
+                                         send_output(websocket, data["request_id"], "err", process.stderr))
+                    await process.wait()
+                packet["status"] = "exited"
+            except TimeoutError:
+                packet["status"] = "timeout"
+            except asyncio.CancelledError:
+                packet["status"] = "cancelled"
+            except ConnectionClosed:
+                # nobody is left to read the output
+                packet["status"] = "disconnected"
+            finally:
+                if process.returncode is None:
+                    kill_process(process)
+                    await process.wait()
+    finally:
+        command_slots.release()
+    packet["code"] = process.returncode if process is not None else None
+    commands_finished.inc(status=packet["status"])
+    try:
+        await websocket.send(json.dumps(packet))
+    except ConnectionClosed:
+        pass
+
+
+def play(events):
+    # runs on the input thread
+    for event in events:
+        try:
+            apply_input(event)
+        except Exception as e:
+            print(f"Failed to apply {event[0]}: {e}")
+
+
+async def acknowledge(websocket: websockets.ClientConnection, future, packet):
+    with input_seconds.time():
+        await future
+    try:
+        await websocket.send(json.dumps(packet))
+    except ConnectionClosed:
+        pass
+
+
+def queue_input(websocket: websockets.ClientConnection, events, packet):
+    # events are queued behind earlier input without waiting, packet is sent once they have been played
+    # the listen loop moves on, a long typewrite does not hold up heartbeats or frames
+    future = asyncio.get_running_loop().run_in_executor(input_executor, play, events)
+    task = asyncio.create_task(acknowledge(websocket, future, packet))
+    acks.add(task)
+    task.add_done_callback(acks.discard)
+
+
+def apply_input(event):
+    kind, args = event[0], event[1:]
+    if kind == "m":
+        pyautogui.moveRel(xOffset=int(args[0]), yOffset=int(args[1]))
+    elif kind == "M":
+        pyautogui.moveTo(x=int(args[0]), y=int(args[1]))
+    elif kind == "c":
+        if int(args[0]) != -1 and int(args[1]) != -1:
+            pyautogui.click(x=int(args[0]), y=int(args[1]), button=args[2], clicks=int(args[3]))
+        else:
+            pyautogui.click(button=args[2], clicks=int(args[3]))
+    elif kind == "w":
+        pyautogui.typewrite(args[0], float(args[1]))
+        if args[2]:
+            pyautogui.press('enter')
+    elif kind == "h":
+        pyautogui.hotkey(*args[0].split())
+    elif kind == "k":
+        pyautogui.press(args[0])
+
+
 async def listen(websocket: websockets.ClientConnection):
     async def snip():
-        print("Taking screenshot")
-        pyautogui.screenshot("snip.png")
-        packet = dict(data)
-        with open("snip.png", mode="rb") as f:
-            packet["data"] = base64.b64encode(f.read()).decode("ascii")
-        await websocket.send(json.dumps(packet))
+        # requests from webserver expect a full frame tagged with their request id
+        if not STREAM or data.get("request_id", 0):
+            packet = dict(data)
+            png = await asyncio.get_running_loop().run_in_executor(capture_executor, grab_png)
+            packet["data"] = base64.b64encode(png).decode("ascii")
+            await websocket.send(json.dumps(packet))
+            return
+
+        # host server asks for a keyframe when it has no frame to apply deltas to
+        await send_frame(websocket, data.get("keyframe", False))
+
+    async def rate():
+        # host server passes on how often viewers want frames of this host
+        global capture_interval
+        capture_interval = data["interval"]
+        rate_changed.set()
 
     async def upload():
         # named upload since file is being uploaded from web to host
 
-        # hostserver relays command from webserver
-        # data would be empty if received from webserver
-        # send the packet back to request the file
-
         # webserver > hostserver > host  |  command is relayed straight to host
-        #             hostserver < host  |  host returns packet with filename
-        #             hostserver > host  |  hostserver returns packet with data
-        if not data.get("data", 0):
-            packet = dict(data)
+        #             hostserver < host  |  host returns packet with filename and offset
+        #             hostserver > host  |  hostserver streams the file in chunks
+        #             hostserver < host  |  host confirms once the last chunk is written
+        request_id = data["request_id"]
+        os.makedirs("downloads", exist_ok=True)
+
+        # the same installer pushed again, or already here under another name
+        if data.get("sha256") and await asyncio.to_thread(place_download, data["sha256"], int(data["size"]),
+                                                          data["filename"]):
+            packet = dict()
+            packet["type"] = "upload"
+            packet["request_id"] = request_id
+            packet["filename"] = data["filename"]
+            packet["done"] = True
+            packet["skipped"] = True
             await websocket.send(json.dumps(packet))
             return
 
-        datafolder = f"downloads/"
-        filename = data["filename"]
-        filepath = os.path.join(datafolder, filename)
+        partpath = part_path(request_id)
+        offset = os.path.getsize(partpath) if os.path.exists(partpath) else 0
+        transfers[request_id] = {"type": "upload", "filename": data["filename"], "offset": offset,
+                                 "sha256": data.get("sha256")}
+        await websocket.send(json.dumps(transfer_packet(request_id)))
+
+    async def chunk():
+        request_id, offset, payload, last, valid = protocol.unpack_chunk(message)
+        transfer = transfers.get(request_id)
+        if transfer is None or transfer["type"] != "upload":
+            return
 
-        # create folder if not exists
-        os.makedirs(datafolder, exist_ok=True)
+        if not valid or offset != transfer["offset"]:
+            # corrupted or out of order chunk, ask again from what we have
+            if not transfer.get("resuming"):
+                transfer["resuming"] = True
+                await websocket.send(json.dumps(transfer_packet(request_id)))
+            return
 
-        with open(filepath, "wb") as f:
-            f.write(base64.b64decode(data["data"]))
-        print(f"Downloaded {data["filename"]}")
+        transfer["resuming"] = False
+        partpath = part_path(request_id)
+        with open(partpath, "ab") as f:
+            f.write(payload)
+        transfer["offset"] += len(payload)
+
+        if last:
+            if transfer.get("sha256") and await asyncio.to_thread(file_hash, partpath) != transfer["sha256"]:
+                # every chunk passed its checksum but the whole does not match, start over
+                os.remove(partpath)
+                transfer["offset"] = 0
+                await websocket.send(json.dumps(transfer_packet(request_id)))
+                return
+            filepath = os.path.join("downloads", transfer["filename"])
+            os.replace(partpath, filepath)
+            if transfer.get("sha256"):
+                file_hashes.pop(partpath, None)
+                stat = os.stat(filepath)
+                file_hashes[filepath] = (stat.st_size, stat.st_mtime_ns, transfer["sha256"])
+            del transfers[request_id]
+            print(f"Downloaded {transfer['filename']}")
+
+            # let host server know the file arrived whole
+            packet = dict()
+            packet["type"] = "upload"
+            packet["request_id"] = request_id
+            packet["filename"] = transfer["filename"]
+            packet["done"] = True
+            await websocket.send(json.dumps(packet))
 
     async def download():
         # named download since file is being downloaded from host to web
-        packet = dict(data)
-        with open(data["filename"], mode="rb") as f:
-            packet["data"] = base64.b64encode(f.read()).decode("ascii")
-        await websocket.send(json.dumps(packet))
-        print(f"Uploaded {data["filename"]}")
+        request_id = data["request_id"]
+
+        # host server has written the last chunk
+        if data.get("done"):
+            transfers.pop(request_id, None)
+            print(f"Uploaded {data['filename']}")
+            return
+
+        # packets from host server carry the offset to stream from
+        # packets relayed from webserver start a new transfer
+        if "offset" not in data:
+            packet = dict()
+            packet["type"] = "download"
+            packet["request_id"] = request_id
+            packet["filename"] = data["filename"]
+            if not os.path.isfile(data["filename"]):
+                packet["error"] = "file not found"
+                await websocket.send(json.dumps(packet))
+                return
+            transfers[request_id] = {"type": "download", "filename": data["filename"]}
+            await websocket.send(json.dumps(packet))
+
+        offset = int(data.get("offset", 0))
+        protocol.start_stream(streams, request_id, protocol.send_file(websocket, request_id, data["filename"], offset))
 
     async def command():
+        # runs next to the listen loop, heartbeats and other packets are not held up
+        request_id = data["request_id"]
+        task = asyncio.create_task(run_command(websocket, dict(data)))
+        commands[request_id] = task
+        task.add_done_callback(lambda _: commands.pop(request_id, None))
+
+    async def cancel():
         packet = dict(data)
-        result = subprocess.run(data["command"], shell=True, text=True, capture_output=True)
-        packet["out"], packet["err"] = result.stdout, result.stderr
+        task = commands.get(data["target"])
+        if task is not None:
+            task.cancel()
+        packet["cancelled"] = task is not None
         await websocket.send(json.dumps(packet))
 
     async def run():
@@ -121,80 +516,125 @@ async def listen(websocket: websockets.ClientConnection):
         os.startfile(data["filename"])
         await websocket.send(json.dumps(packet))
 
+    # form actions go through the same input thread as the control page, in the order they arrive
     async def move():
-        packet = dict(data)
-        if data["relative"] == "False":
-            pyautogui.moveTo(x=int(data["x"]), y=int(data["y"]))
-        else:
-            pyautogui.moveRel(xOffset=int(data["x"]), yOffset=int(data["y"]))
-        await websocket.send(json.dumps(packet))
+        kind = "M" if data["relative"] == "False" else "m"
+        queue_input(websocket, [[kind, data["x"], data["y"]]], dict(data))
 
     async def click():
-        packet = dict(data)
-        if int(data["x"]) != -1 and int(data["y"]) != -1:
-            pyautogui.click(x=int(data["x"]), y=int(data["y"]), button=data["button"], clicks=int(data["clicks"]))
-        else:
-            pyautogui.click(button=data["button"], clicks=int(data["clicks"]))
-        await websocket.send(json.dumps(packet))
+        queue_input(websocket, [["c", data["x"], data["y"], data["button"], data["clicks"]]], dict(data))
 
     async def write():
-        packet = dict(data)
-        pyautogui.typewrite(data["text"], float(data["speed"]))
-        if data["enter"] == "True":
-            pyautogui.press('enter')
-        await websocket.send(json.dumps(packet))
+        queue_input(websocket, [["w", data["text"], data["speed"], data["enter"] == "True"]], dict(data))
 
     async def hotkey():
-        packet = dict(data)
-        pyautogui.hotkey(data["text"].split())
-        await websocket.send(json.dumps(packet))
+        queue_input(websocket, [["h", data["text"]]], dict(data))
+
+    async def input():
+        # a batch of events from one control page, numbered from seq on
+        channel = data["channel"]
+        if data.get("close"):
+            input_seqs.pop(channel, None)
+            return
+        seq, events = data["seq"], data["events"]
+        # checked by webserver too, a bad batch is dropped here rather than ending the listen loop
+        if not isinstance(seq, int) or not isinstance(events, list) or not all(map(protocol.valid_input, events)):
+            print("Invalid input batch")
+            return
+        last = input_seqs.get(channel, seq - 1)
+        input_seqs[channel] = max(last, seq + len(events) - 1)
+        events = protocol.coalesce(events[max(0, last + 1 - seq):])
+
+        # one ack covers every event up to it, sent once they have been played back
+        packet = dict()
+        packet["type"] = "input"
+        packet["channel"] = channel
+        packet["ack"] = input_seqs[channel]
+        queue_input(websocket, events, packet)
+
+    # maps binary frame kind to a function
+    binary_map = {
+        protocol.FRAME_CHUNK: chunk,
+    }
 
     # maps packet type to a function
     func_map = {
         "snip": snip,
+        "rate": rate,
         "upload": upload,
         "download": download,
         'command': command,
+        'cancel': cancel,
         'run': run,
         'move': move,
         'click': click,
         'write': write,
         'hotkey': hotkey,
+        'input': input,
     }
 
     async for message in websocket:
         try:
+            if isinstance(message, bytes):
+                await binary_map[message[0]]()
+                continue
             data = json.loads(message)
+            packets_received.inc(type=data.get("type"))
             # call the function corresponding to the packet type
             await func_map[data['type']]()
         except json.JSONDecodeError:
             print("Invalid JSON data")
         except KeyError as e:
             print(f"Invalid key: {e}")
+        except (TypeError, ValueError, IndexError) as e:
+            # one malformed packet must not take the host offline
+            print(f"Invalid packet: {e}")
+
+
+async def dump_stats():
+    while True:
+        await asyncio.sleep(STATS_INTERVAL)
+        with open(STATS_FILE, "w") as f:
+            f.write(metrics.render())
 
 
 async def main():
     # main loop to keep the connection alive
+    server = IP
+    # kept across reconnects
+    background = [asyncio.create_task(metrics.watch_loop_lag()), asyncio.create_task(dump_stats())]
     while True:
         try:
             print("Connecting to host server")
             # max_size is set to 100MB
             # which is the maximum message size allowed by the server
-            async with websockets.connect(IP, max_size=100*1024*1024) as websocket:
+            # files are sent in chunks so this only bounds single frames
+            async with websockets.connect(server, max_size=100*1024*1024) as websocket:
                 print("Connection established")
 
                 # load configuration and authenticate
                 await on_ready(websocket)
-                await hello(websocket)
+                redirect = await hello(websocket)
+                if redirect:
+                    print(f"Redirected to {redirect}")
+                    server = redirect
+                    continue
+                await resume_transfers(websocket)
 
                 # start heartbeat and listen tasks
                 heartbeat_task = asyncio.create_task(heartbeat(websocket))
                 listen_task = asyncio.create_task(listen(websocket))
-                await asyncio.gather(listen_task, heartbeat_task)
+                tasks = [listen_task, heartbeat_task]
+                if STREAM:
+                    tasks.append(asyncio.create_task(capture(websocket)))
+                await asyncio.gather(*tasks)
         except (ConnectionError,
                 ConnectionClosed,
                 ConnectionClosedError) as e:
             print(e)
+            reconnects.inc()
+            # start over at the entry node, it knows where this host belongs now
+            server = IP
             # try to reconnect after 5 seconds if connection is lost
             await asyncio.sleep(5)
 
@@ -0,0 +1,225 @@
+import asyncio
+import json
+import random
+from uuid import uuid4
+
+import websockets
+
+# seconds before the first reconnect attempt, doubled after every failed attempt up to RECONNECT_MAX
+RECONNECT_BASE = 0.5
+RECONNECT_MAX = 30
+# packets waiting to be written before senders have to wait for room
+OUTBOUND_QUEUE_SIZE = 1000
+# upper bound on requests waiting for a reply, so an offline host can not grow the table forever
+MAX_PENDING_REQUESTS = 10000
+
+
+class LinkUnavailable(Exception):
+    pass
+
+
+class HostServerLink:
+    # webserver's connection to hostserver, runs as a task on the app's event loop
+    # requests are written by one writer task in order, replies resolve the future of their request_id
+    # every other packet from hostserver is passed to on_packet
+    # hostserver only pushes events to links that ask for them, one per webserver is enough
+
+    def __init__(self, url, events=True, on_packet=None, on_connect=None, on_disconnect=None):
+        self.url = url
+        self.events = events
+        self.on_packet = on_packet
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+        self.websocket = None
+        self.outbound = asyncio.Queue(OUTBOUND_QUEUE_SIZE)
+        # request_id -> future resolved when hostserver replies, or queue of a reply that comes in parts
+        self.pending = dict()
+        self.task = None
+        self.connect_task = None
+
+    @property
+    def connected(self):
+        return self.websocket is not None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+
+    async def run(self):
+        attempt = 0
+        while True:
+            try:
+                async with websockets.connect(self.url) as websocket:
+                    await self.auth(websocket)
+                    attempt = 0
+                    self.websocket = websocket
+                    writer = asyncio.create_task(self.write(websocket))
+                    if self.on_connect:
+                        self.connect_task = asyncio.create_task(self.on_connect())
+                    try:
+                        await self.read(websocket)
+                    finally:
+                        writer.cancel()
+                        await asyncio.gather(writer, return_exceptions=True)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(e)
+            finally:
+                self.disconnected()
+            # back off so a restarting hostserver is not hammered by reconnects
+            delay = min(RECONNECT_MAX, RECONNECT_BASE * 2 ** attempt) * random.uniform(0.5, 1)
+            attempt += 1
+            print(f"Reconnecting in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def auth(self, websocket):
+        packet = dict()
+        print(f"Connecting with Host Server")
+        packet['type'] = "hello"
+        packet['host_id'] = "backend"
+        packet['events'] = self.events
+        await websocket.send(json.dumps(packet))
+        print(await websocket.recv())
+
+    async def read(self, websocket):
+        async for message in websocket:
+            try:
+                data = json.loads(message)
+            except json.JSONDecodeError:
+                print("Invalid JSON data")
+                continue
+
+            future = self.pending.get(data.get("request_id"))
+            if isinstance(future, asyncio.Queue):
+                future.put_nowait(data)
+            elif future is not None:
+                if not future.done():
+                    future.set_result(data)
+            elif self.on_packet:
+                # events, and replies for requests that already timed out
+                self.on_packet(data)
+
+    async def write(self, websocket):
+        while True:
+            message = await self.outbound.get()
+            await websocket.send(message)
+
+    def disconnected(self):
+        # runs after every attempt, most of them never got connected while the node is down
+        was_connected = self.websocket is not None
+        self.websocket = None
+        if self.connect_task is not None:
+            self.connect_task.cancel()
+            self.connect_task = None
+        # packets queued for the old connection must not leak into the next one
+        while not self.outbound.empty():
+            self.outbound.get_nowait()
+        # nothing will answer requests made on the old connection, fail them now instead of at their timeout
+        for future in self.pending.values():
+            if isinstance(future, asyncio.Queue):
+                future.put_nowait(LinkUnavailable("Lost connection to host server"))
+            elif not future.done():
+                future.set_exception(LinkUnavailable("Lost connection to host server"))
+        if self.on_disconnect and was_connected:
+            self.on_disconnect()
+
+    async def send(self, packet):
+        if not self.connected:
+            raise LinkUnavailable("Host server is not connected")
+        # waits while the queue is full, a burst of requests slows down instead of piling up
+        await self.outbound.put(json.dumps(packet))
+
+    def register(self, packet, future):
+        if len(self.pending) >= MAX_PENDING_REQUESTS:
+            raise LinkUnavailable("Too many pending requests")
+        request_id = str(uuid4())
+        while request_id in self.pending:
+            request_id = str(uuid4())
+        self.pending[request_id] = future
+        packet["request_id"] = request_id
+        return request_id
+
+    async def request(self, packet, timeout):
+        # sends a packet and waits for the reply with the same request_id
+        # raises TimeoutError if none arrives in time, LinkUnavailable if it can not be sent
+        future = asyncio.get_running_loop().create_future()
+        request_id = self.register(packet, future)
+        try:
+            async with asyncio.timeout(timeout):
+                await self.send(packet)
+                return await future
+        finally:
+            # timed out or cancelled requests must not stay in the table
+            del self.pending[request_id]
+
+    async def stream(self, packet, timeout):
+        # like request, for replies sent in parts, yields every part up to the first without "more"
+        # timeout covers the whole reply, not each part
+        queue = asyncio.Queue()
+        request_id = self.register(packet, queue)
+        deadline = asyncio.get_running_loop().time() + timeout
+        try:
+            async with asyncio.timeout_at(deadline):
+                await self.send(packet)
+            while True:
+                async with asyncio.timeout_at(deadline):
+                    data = await queue.get()
+                if isinstance(data, Exception):
+                    raise data
+                yield data
+                if not data.get("more"):
+                    return
+        finally:
+            del self.pending[request_id]
+
+
+class HostServerPool:
+    # a few links to hostserver grouped in lanes, so a slow file transfer never queues ahead of a click
+    # lanes maps a lane name to its number of links, the first link of the first lane carries events
+
+    def __init__(self, url, lanes, on_packet=None, on_connect=None, on_disconnect=None):
+        self.lanes = dict()
+        self.events = None
+        for lane, size in lanes.items():
+            self.lanes[lane] = []
+            for _ in range(size):
+                if self.events is None:
+                    link = HostServerLink(url, True, on_packet, on_connect, on_disconnect)
+                    self.events = link
+                else:
+                    link = HostServerLink(url, False, on_packet)
+                self.lanes[lane].append(link)
+
+    @property
+    def links(self):
+        return [link for links in self.lanes.values() for link in links]
+
+    def start(self):
+        for link in self.links:
+            link.start()
+
+    async def stop(self):
+        await asyncio.gather(*[link.stop() for link in self.links])
+
+    def link_for(self, key, lane):
+        # always the same link for a key, packets sent on it arrive in the order they were sent
+        links = self.lanes[lane]
+        return links[hash(key) % len(links)]
+
+    def pick(self, lane):
+        # least busy connected link of the lane, any connected link if the whole lane is down
+        links = [_ for _ in self.lanes[lane] if _.connected] or [_ for _ in self.links if _.connected]
+        if not links:
+            raise LinkUnavailable("Host server is not connected")
+        return min(links, key=lambda _: len(_.pending))
+
+    async def request(self, packet, timeout, lane):
+        return await self.pick(lane).request(packet, timeout)
+
+    async def stream(self, packet, timeout, lane):
+        async for data in self.pick(lane).stream(packet, timeout):
+            yield data
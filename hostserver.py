@@ -1,19 +1,388 @@
 import asyncio
 import base64
 import datetime
-import glob
+import io
 import json
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
 from uuid import uuid4
 
 import pymongo
 import websockets
-from dotenv import load_dotenv
-
-load_dotenv()
-db = pymongo.MongoClient(os.getenv("CONN_STRING"))["remote"]
+from PIL import Image
+from websockets import ConnectionClosed
+from websockets.datastructures import Headers
+from websockets.http11 import Response
+
+import blobs
+import cluster
+import database
+import metrics
+import protocol
+import snipstore
+
+# url of this node as listed in HOSTSERVER_NODES, set by main
+node_url = None
 connected = dict()
-backend_server: websockets.ServerConnection
+# webserver sessions that asked for events, every one of them gets each event
+backends = set()
+# request_id -> webserver session that sent the request, its reply goes back there
+routes = dict()
+# requests a reply may still be routed for, the oldest are forgotten first
+MAX_ROUTES = 100000
+# host_id -> {webserver session: seconds between frames its viewers want}
+watchers = dict()
+# input channel -> webserver session it came from, acks from the host go back there
+input_channels = dict()
+# uuids of every registered host, loaded once at startup and kept current by setup
+known_hosts = set()
+# host_id -> lastSeen not yet written to mongo, flushed as one bulk write
+last_seen = dict()
+# seconds between lastSeen flushes
+LAST_SEEN_FLUSH_INTERVAL = 10
+# latest full frame per host, binary snips only carry the tiles that changed
+frames = dict()
+# hosts that lost a frame to a full queue, their deltas are skipped until the next keyframe
+stale = set()
+# host_id -> log its snips are appended to, dropped when the host goes offline
+snip_logs = dict()
+# seconds between sweeps for history of hosts that are not sending snips, a log only prunes itself when it rolls
+SNIP_PRUNE_INTERVAL = snipstore.SEGMENT_MS // 1000
+# host_id -> [start, end] of each recording, end is None while recording, their snips outlive the retention
+recordings = dict()
+# seconds after which a recording nobody stopped is stopped
+RECORDING_MAX = int(os.getenv("RECORDING_MAX_SECONDS", 4 * 3600))
+# host_id -> lock held while its recordings are changed, record requests wait on mongo off the session loop
+recording_locks = dict()
+# record requests still waiting on mongo
+record_tasks = set()
+# host_id -> [timestamp, kind, detail] relayed to it and not yet written next to its snips
+recorded_events = dict()
+# seconds between writes of recorded events
+EVENT_FLUSH_INTERVAL = 1
+# commands kept in recordings, everything else is a transfer or a query
+RECORDED_COMMANDS = {"move", "click", "write", "hotkey", "command", "run"}
+# snips are decoded, composed and written on this pool so the loop only relays packets
+SNIP_WORKERS = os.cpu_count() or 4
+snip_executor = ThreadPoolExecutor(max_workers=SNIP_WORKERS, thread_name_prefix="snip")
+# one queue per worker, a host that outruns its worker loses frames instead of growing memory
+snip_queues = []
+SNIP_QUEUE_SIZE = 32
+# scrapers of /metrics send it as a bearer token, /metrics is open when unset
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+# downloads from hosts in progress, request_id -> {"filename": ..., "path": ..., "offset": ...}
+transfers = dict()
+# request_id -> task streaming an upload to a host
+streams = dict()
+
+packets_received = metrics.Counter("hostserver_packets_total", "Packets received, by type")
+heartbeat_interval = metrics.Histogram("hostserver_heartbeat_interval_seconds", "Time between heartbeats of a host")
+snip_bytes = metrics.Histogram("hostserver_snip_bytes", "Size of snips received, by kind", metrics.SIZE_BUCKETS)
+snip_seconds = metrics.Histogram("hostserver_snip_ingest_seconds", "Decoding, composing and storing a snip")
+snips_dropped = metrics.Counter("hostserver_snips_dropped_total", "Snips dropped because their worker was behind")
+metrics.Gauge("hostserver_connected_hosts", "Hosts connected to this node", lambda: len(connected))
+metrics.Gauge("hostserver_backend_sessions", "Webserver sessions receiving events", lambda: len(backends))
+metrics.Gauge("hostserver_routes", "Requests waiting for a reply from a host", lambda: len(routes))
+metrics.Gauge("hostserver_watched_hosts", "Hosts someone is watching", lambda: len(watchers))
+metrics.Gauge("hostserver_snip_queue_depth", "Snips waiting for a worker", lambda: sum(_.qsize() for _ in snip_queues))
+metrics.Gauge("hostserver_transfers", "Downloads from hosts in progress", lambda: len(transfers))
+metrics.Gauge("hostserver_blob_cache_bytes", "Upload chunks kept in memory", lambda: blobs.cached_bytes)
+metrics.Gauge("hostserver_recording_hosts", "Hosts being recorded",
+              lambda: sum(1 for _ in recordings.values() if _ and _[-1][1] is None))
+
+
+async def load_known_hosts():
+    # unique index keeps uuid lookups off a collection scan and rejects duplicate uuids
+    await database.create_index("hosts", "uuid", unique=True)
+    res = await database.find("hosts", {}, {"_id": 0, "uuid": 1})
+    known_hosts.update(_["uuid"] for _ in res)
+    print(f"Loaded {len(known_hosts)} known hosts")
+
+
+async def is_known_host(host_id):
+    if host_id in known_hosts:
+        return True
+    # host may have been registered by another process since startup
+    if await database.find_one("hosts", {"uuid": host_id}, {"_id": 0, "uuid": 1}):
+        known_hosts.add(host_id)
+        return True
+    return False
+
+
+async def flush_last_seen():
+    if not last_seen:
+        return
+    # take the buffer first so timestamps arriving during the write go to the next flush
+    pending = dict(last_seen)
+    last_seen.clear()
+    requests = [pymongo.UpdateOne({"uuid": host_id}, {"$set": {"lastSeen": seen}})
+                for host_id, seen in pending.items()]
+    try:
+        await database.bulk_write("hosts", requests, ordered=False)
+    except pymongo.errors.PyMongoError as e:
+        print(f"Failed to flush last seen times: {e}")
+        # keep newer timestamps that arrived in the meantime
+        for host_id, seen in pending.items():
+            last_seen.setdefault(host_id, seen)
+
+
+async def flush_last_seen_periodically():
+    while True:
+        await asyncio.sleep(LAST_SEEN_FLUSH_INTERVAL)
+        await flush_last_seen()
+
+
+async def load_recordings():
+    res = await database.find("recordings", {}, {"_id": 0, "uuid": 1, "start": 1, "end": 1})
+    for recording in sorted(res, key=lambda _: _["start"]):
+        recordings.setdefault(recording["uuid"], []).append([recording["start"], recording["end"]])
+    print(f"Loaded {len(res)} recordings")
+
+
+def owns(host_id):
+    # hosts this node stores snips and recordings for
+    return node_url not in cluster.ring.nodes or cluster.ring.node_for(host_id) == node_url
+
+
+def is_recording(host_id):
+    ranges = recordings.get(host_id)
+    return bool(ranges) and ranges[-1][1] is None and snipstore.now_ms() - ranges[-1][0] < RECORDING_MAX * 1000
+
+
+async def stop_recording(host_id, end):
+    ranges = recordings[host_id]
+    await database.update_one("recordings", {"uuid": host_id, "end": None}, {"$set": {"end": end}})
+    ranges[-1][1] = end
+
+
+async def stop_long_recordings():
+    # a recording nobody stopped would keep its host's history forever
+    for host_id, ranges in list(recordings.items()):
+        if ranges and ranges[-1][1] is None and not is_recording(host_id) and owns(host_id):
+            try:
+                async with recording_locks.setdefault(host_id, asyncio.Lock()):
+                    # a record request may have stopped it while waiting for the lock
+                    if ranges and ranges[-1][1] is None:
+                        await stop_recording(host_id, ranges[-1][0] + RECORDING_MAX * 1000)
+            except pymongo.errors.PyMongoError as e:
+                print(f"Failed to stop recording of {host_id}: {e}")
+
+
+def record_event(host_id, kind, detail):
+    # input is only kept while the host is being recorded, it may hold passwords typed into the host
+    if not is_recording(host_id):
+        return
+    # only buffered here, the loop never waits on the disk for a relay
+    recorded_events.setdefault(host_id, []).append([snipstore.now_ms(), kind, detail])
+
+
+def write_events(pending):
+    for host_id, events in pending.items():
+        try:
+            snipstore.append_events(host_id, events)
+        except OSError as e:
+            print(f"Failed to write events of {host_id}: {e}")
+
+
+async def flush_events():
+    global recorded_events
+    if not recorded_events:
+        return
+    # take the buffer first so events relayed during the write go to the next flush
+    pending, recorded_events = recorded_events, dict()
+    await asyncio.to_thread(write_events, pending)
+
+
+async def flush_events_periodically():
+    while True:
+        await asyncio.sleep(EVENT_FLUSH_INTERVAL)
+        await flush_events()
+
+
+async def publish(event, host_id, **fields):
+    # events carry no request_id, webserver pushes them to every open dashboard
+    packet = dict()
+    packet["type"] = "event"
+    packet["event"] = event
+    packet["uuid"] = host_id
+    packet.update(fields)
+    # written without waiting, one slow webserver does not hold back events for the others
+    websockets.broadcast(backends, json.dumps(packet))
+
+
+def add_route(request_id, backend):
+    routes[request_id] = backend
+    if len(routes) > MAX_ROUTES:
+        # a reply that never came, host went offline in the middle of the request
+        del routes[next(iter(routes))]
+
+
+async def reply(packet, last=True):
+    # replies sent in parts keep their route until the last one
+    if last:
+        backend = routes.pop(packet["request_id"], None)
+    else:
+        backend = routes.get(packet["request_id"])
+    if backend is None:
+        return
+    try:
+        await backend.send(json.dumps(packet))
+    except ConnectionClosed:
+        pass
+
+
+def capture_interval(host_id):
+    # the closest look any webserver wants decides the rate
+    intervals = watchers.get(host_id, {}).values()
+    return min(intervals) if intervals else protocol.IDLE_INTERVAL
+
+
+async def send_rate(host_id):
+    websocket = connected.get(host_id)
+    if websocket is None:
+        return
+    packet = dict()
+    packet["type"] = "rate"
+    packet["interval"] = capture_interval(host_id)
+    try:
+        await websocket.send(json.dumps(packet))
+    except ConnectionClosed:
+        pass
+
+
+async def set_watch(backend, host_id, interval):
+    # interval is None once nobody on that webserver is watching the host
+    before = capture_interval(host_id)
+    sessions = watchers.setdefault(host_id, {})
+    if interval:
+        sessions[backend] = interval
+    else:
+        sessions.pop(backend, None)
+    if not sessions:
+        del watchers[host_id]
+    if capture_interval(host_id) != before:
+        await send_rate(host_id)
+
+
+def prune_snips():
+    # runs in a thread, hosts with a log are left to it
+    now = snipstore.now_ms()
+    try:
+        host_ids = os.listdir("data")
+    except FileNotFoundError:
+        return
+    for host_id in host_ids:
+        # another node's recordings of its hosts are not known here
+        if host_id in snip_logs or not owns(host_id) or not os.path.isdir(snipstore.folder(host_id)):
+            continue
+        snipstore.SnipLog(host_id, recordings.get(host_id, [])).prune(now)
+
+
+async def prune_snips_periodically():
+    while True:
+        await asyncio.sleep(SNIP_PRUNE_INTERVAL)
+        await stop_long_recordings()
+        try:
+            await asyncio.to_thread(prune_snips)
+        except OSError as e:
+            print(f"Failed to prune snips: {e}")
+
+
+def open_download(partpath, resume):
+    # runs in a thread, returns how much of the file is already here
+    os.makedirs(os.path.dirname(partpath), exist_ok=True)
+    if not resume or not os.path.exists(partpath):
+        open(partpath, "wb").close()
+    return os.path.getsize(partpath)
+
+
+def append_chunk(partpath, payload):
+    # runs in a thread, chunks of one transfer are written in order since the host's packets are handled in order
+    with open(partpath, "ab") as f:
+        f.write(payload)
+
+
+def store_snip(host_id, image_data, fmt="png"):
+    # returns the timestamp the snip is stored under, or None if the host went offline while it was queued
+    if host_id not in connected:
+        return None
+    log = snip_logs.get(host_id)
+    if log is None:
+        log = snip_logs[host_id] = snipstore.SnipLog(host_id, recordings.setdefault(host_id, []))
+    return log.append(image_data, fmt)
+
+
+def ingest_frame(host_id, message):
+    # runs on a snip worker, returns the stored timestamp or None if the host has to send a keyframe
+    if host_id not in connected:
+        return None
+    keyframe, size, tiles = protocol.unpack_snip(message)
+    frame = frames.get(host_id)
+    if keyframe:
+        stale.discard(host_id)
+        frame = Image.new("RGB", size)
+    elif frame is None or frame.size != size or host_id in stale:
+        # delta for a frame we do not have
+        return None
+
+    for x, y, tile in tiles:
+        frame.paste(Image.open(io.BytesIO(tile)), (x, y))
+    frames[host_id] = frame
+
+    # lossless webp at its fastest setting is smaller and quicker to encode than png for screen content
+    buffer = io.BytesIO()
+    frame.save(buffer, format="WEBP", lossless=True, quality=0, method=0)
+    return store_snip(host_id, buffer.getbuffer(), "webp")
+
+
+async def snip_worker(queue):
+    loop = asyncio.get_running_loop()
+    while True:
+        job, done = await queue.get()
+        try:
+            with snip_seconds.time():
+                timestamp = await loop.run_in_executor(snip_executor, job)
+            await done(timestamp)
+        except Exception as e:
+            print(f"Failed to store snip: {e}")
+
+
+def start_snip_workers():
+    tasks = []
+    for _ in range(SNIP_WORKERS):
+        queue = asyncio.Queue(SNIP_QUEUE_SIZE)
+        snip_queues.append(queue)
+        tasks.append(asyncio.create_task(snip_worker(queue)))
+    return tasks
+
+
+def forget_host(host_id):
+    # drops the state kept for an online host, its history is pruned by prune_snips from now on
+    frames.pop(host_id, None)
+    snip_logs.pop(host_id, None)
+    stale.discard(host_id)
+
+
+def submit_snip(host_id, job, done):
+    # a host always lands on the same worker so its deltas are applied in order
+    # raises asyncio.QueueFull when that worker is behind
+    queue = snip_queues[hash(host_id) % len(snip_queues)]
+    queue.put_nowait((job, done))
+
+
+def process_request(connection, request):
+    # plain http requests for metrics, websocket handshakes pass through
+    if request.path == "/metrics":
+        if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+            return connection.respond(HTTPStatus.UNAUTHORIZED, "Invalid metrics token\n")
+        headers = Headers()
+        headers["Content-Type"] = "text/plain; version=0.0.4"
+        body = metrics.render().encode()
+        headers["Content-Length"] = str(len(body))
+        return Response(HTTPStatus.OK, "OK", headers, body)
+    return None
 
 
 async def handler(websocket: websockets.ServerConnection):
@@ -23,44 +392,52 @@ async def handler(websocket: websockets.ServerConnection):
     }
 
     async def db_update():
-        document = {
-            "lastSeen": host["last"]
-        }
-        db["hosts"].find_one_and_update({"uuid": host["id"]}, {"$set": document})
-        print(f"Updated last seen time for host {host['id']}")
+        # written to mongo by flush_last_seen
+        last_seen[host["id"]] = host["last"]
 
     async def setup():
-        res = db["hosts"].find({}, {"_id": 0, "uuid": 1})
-        uuids = [_["uuid"] for _ in list(res)]
-        res.close()
-        host_id = str(uuid4())
-        while host_id in uuids:
-            host_id = str(uuid4())
-
         now = datetime.datetime.now(datetime.UTC)
-        document = {
-            "uuid": host_id,
-            "name": "...",
-            "lastSeen": now,
-            "timeCreated": now
-        }
-        db["hosts"].insert_one(document)
+        while True:
+            host_id = str(uuid4())
+            if host_id in known_hosts:
+                continue
+            document = {
+                "uuid": host_id,
+                "name": "...",
+                "lastSeen": now,
+                "timeCreated": now
+            }
+            try:
+                await database.insert_one("hosts", document)
+                break
+            except pymongo.errors.DuplicateKeyError:
+                # taken by a host registered elsewhere, try another one
+                known_hosts.add(host_id)
+        known_hosts.add(host_id)
         await websocket.send(host_id)
 
     async def hello():
         if data["host_id"] == "backend":
-            global backend_server
-            backend_server = websocket
+            # any number of webservers may connect, each over several sessions
+            if data.get("events", True):
+                backends.add(websocket)
             host["auth"] = True
             host["id"] = data["host_id"]
             print("Connection Established with backend")
             await websocket.send("Host Server is now connected with Backend")
             return
 
-        res = db["hosts"].find({}, {"_id": 0, "uuid": 1})
-        uuids = [_["uuid"] for _ in list(res)]
-        res.close()
-        if data["host_id"] not in uuids:
+        owner = cluster.ring.node_for(data["host_id"])
+        if node_url in cluster.ring.nodes and owner != node_url:
+            # host belongs to another node of the cluster
+            packet = dict()
+            packet["type"] = "redirect"
+            packet["url"] = owner
+            await websocket.send(json.dumps(packet))
+            await websocket.close()
+            return
+
+        if not await is_known_host(data["host_id"]):
             print("Invalid UUID. Closing connection")
             await websocket.close()
             return
@@ -68,18 +445,27 @@ async def handler(websocket: websockets.ServerConnection):
         host["auth"] = True
         host['id'] = data['host_id']
         host['last'] = datetime.datetime.now(datetime.UTC)
+        # hosts that capture on their own only need to be told the rate
+        host['rates'] = data.get("rates", False)
         print(f"Connection Established with host: {data['host_id']}")
         connected[host['id']] = websocket
         await db_update()
+        await publish("online", host["id"])
         await websocket.send("Hello Acknowledgment")
+        if host['rates']:
+            await send_rate(host['id'])
 
     async def heartbeat():
         now = datetime.datetime.now(datetime.UTC)
-        beat = now - host["last"]
-        print(f"Last heartbeat was {beat.total_seconds():.2f}s ago")
+        heartbeat_interval.observe((now - host["last"]).total_seconds())
         host['last'] = now
+        await db_update()
+        if host['rates']:
+            return
         packet = dict()
         packet["type"] = "snip"
+        # without a base frame deltas can not be applied
+        packet["keyframe"] = host["id"] not in frames
         await websocket.send(json.dumps(packet))
 
     async def echo():
@@ -95,103 +481,334 @@ async def handler(websocket: websockets.ServerConnection):
         packet["hosts"] = list(connected.keys())
         await websocket.send(json.dumps(packet))
 
+    async def rate():
+        # how often viewers on one webserver want frames of each host
+        if host["id"] != "backend":
+            return
+        for host_id, interval in data["hosts"].items():
+            await set_watch(websocket, host_id, interval)
+
+    async def input():
+        if host["id"] == "backend":
+            input_channels[data["channel"]] = websocket
+            if data.get("close"):
+                del input_channels[data["channel"]]
+            packet = dict(data)
+            del packet["uuid"]
+            try:
+                await connected[data["uuid"]].send(json.dumps(packet))
+                if "events" in data:
+                    record_event(data["uuid"], "input", data["events"])
+            except (KeyError, ConnectionClosed):
+                packet = dict()
+                packet["type"] = "input"
+                packet["channel"] = data["channel"]
+                packet["error"] = "host offline"
+                await websocket.send(json.dumps(packet))
+            return
+
+        # cumulative ack from the host
+        backend = input_channels.get(data["channel"])
+        if backend is not None:
+            try:
+                await backend.send(json.dumps(data))
+            except ConnectionClosed:
+                pass
+
     async def cmd():
+        add_route(data["request_id"], websocket)
         try:
             packet = dict(data)
             packet["type"] = data["cmd"]
             del packet["cmd"]
             del packet["uuid"]
             await connected[data["uuid"]].send(json.dumps(packet))
+            if data["cmd"] in RECORDED_COMMANDS:
+                detail = dict(packet)
+                del detail["type"], detail["request_id"]
+                record_event(data["uuid"], data["cmd"], detail)
         except KeyError:
             print("Host is not online or invalid uuid")
             packet = dict()
             packet["request_id"] = data["request_id"]
             packet["ack"] = "host offline"
-            await backend_server.send(json.dumps(packet))
+            await reply(packet)
 
-    async def snip():
-        datafolder = f"data/{host['id']}/snip"
-        timestamp = datetime.datetime.now(datetime.UTC).strftime("%Y-%m-%d_%H-%M-%S")
-        filename = f"{timestamp}.png"
-        filepath = os.path.join(datafolder, filename)
+    async def record():
+        # starts, stops or deletes a recording of a host on the node that stores its snips
+        if host["id"] != "backend":
+            return
+        add_route(data["request_id"], websocket)
+        # data is replaced by the next packet before the task gets to this one
+        task = asyncio.create_task(change_recording(dict(data)))
+        record_tasks.add(task)
+        task.add_done_callback(record_tasks.discard)
+
+    async def change_recording(request):
+        host_id = request["uuid"]
+        packet = dict()
+        packet["request_id"] = request["request_id"]
+        try:
+            async with recording_locks.setdefault(host_id, asyncio.Lock()):
+                packet["ack"] = await apply_recording(request, packet)
+        except KeyError as e:
+            print(f"Invalid key: {e}")
+            packet["ack"] = "invalid request"
+        except pymongo.errors.PyMongoError as e:
+            print(f"Failed to {request.get('action')} recording of {host_id}: {e}")
+            packet["ack"] = "database error"
+        await reply(packet)
+
+    async def apply_recording(request, packet):
+        # returns the ack, start and end of the recording are added to packet
+        host_id = request["uuid"]
+        ranges = recordings.setdefault(host_id, [])
+        if ranges and ranges[-1][1] is None and not is_recording(host_id):
+            # ran past RECORDING_MAX, it ended there
+            await stop_recording(host_id, ranges[-1][0] + RECORDING_MAX * 1000)
+        if request["action"] == "delete":
+            recording = await database.find_one("recordings", {"id": request["id"], "uuid": host_id}, {"_id": 0})
+            if recording is None:
+                return "recording not found"
+            await database.delete_one("recordings", {"id": request["id"]})
+            # the same list is the log's keep, its segments are pruned with the rest from now on
+            ranges[:] = [_ for _ in ranges if _[0] != recording["start"]]
+            return "delete"
+        if request["action"] == "start":
+            if not ranges or ranges[-1][1] is not None:
+                document = {
+                    "id": str(uuid4()),
+                    "uuid": host_id,
+                    "start": snipstore.now_ms(),
+                    "end": None,
+                    "user": request.get("user"),
+                }
+                await database.insert_one("recordings", document)
+                ranges.append([document["start"], None])
+            packet["start"] = ranges[-1][0]
+        elif ranges and ranges[-1][1] is None:
+            await stop_recording(host_id, snipstore.now_ms())
+            packet["start"], packet["end"] = ranges[-1]
+        else:
+            return "not recording"
+        return request["action"]
 
-        os.makedirs(datafolder, exist_ok=True)
-        files = glob.glob("*.png", root_dir=datafolder)
-        older_files = sorted(files)[:-10]
-        for i in older_files:
-            os.remove(os.path.join(datafolder, i))
+    async def snip():
+        # data is replaced by the next packet before the worker gets to this one
+        host_id, image_data, request_id = host["id"], data["data"], data.get("request_id", 0)
+        snip_bytes.observe(len(image_data) * 3 // 4, kind="png")
+
+        def job():
+            return store_snip(host_id, base64.b64decode(image_data))
+
+        async def done(timestamp):
+            if host_id not in connected:
+                # went offline while the snip was queued or stored
+                forget_host(host_id)
+                if request_id:
+                    packet = dict()
+                    packet["request_id"] = request_id
+                    packet["ack"] = "host offline"
+                    await reply(packet)
+                return
+            await publish("snip", host_id, timestamp=timestamp)
+            if request_id:
+                packet = dict()
+                packet["request_id"] = request_id
+                packet["ack"] = "updated snip"
+                await reply(packet)
 
-        with open(filepath, "wb") as f:
-            f.write(base64.b64decode(data["data"]))
+        try:
+            submit_snip(host_id, job, done)
+        except asyncio.QueueFull:
+            snips_dropped.inc(kind="png")
+            if request_id:
+                packet = dict()
+                packet["request_id"] = request_id
+                packet["ack"] = "snip dropped"
+                await reply(packet)
 
-        if data.get("request_id", 0):
+    async def upload():
+        # host has written the last chunk
+        if data.get("done"):
             packet = dict()
             packet["request_id"] = data["request_id"]
-            packet["ack"] = "updated snip"
-            await backend_server.send(json.dumps(packet))
-
-    async def upload():
-        packet = dict(data)
-        with open(data["filename"], mode="rb") as f:
-            packet["data"] = base64.b64encode(f.read()).decode("ascii")
-        await websocket.send(json.dumps(packet))
+            packet["ack"] = "upload"
+            # host already had a file with the same hash
+            packet["skipped"] = data.get("skipped", False)
+            await reply(packet)
+            return
 
-        packet = dict()
-        packet["request_id"] = data["request_id"]
-        packet["ack"] = "upload"
-        await backend_server.send(json.dumps(packet))
+        # host asks for the file starting at the offset it already has
+        offset = int(data.get("offset", 0))
+        # only stored uploads are sent, the digest comes from the host and must not name any other file
+        if not blobs.is_digest(data.get("sha256")) or not os.path.exists(blobs.blob_path(data["sha256"])):
+            packet = dict()
+            packet["request_id"] = data["request_id"]
+            packet["ack"] = "file not found"
+            await reply(packet)
+            return
+        protocol.start_stream(streams, data["request_id"],
+                              blobs.send_blob(websocket, data["request_id"], data["sha256"], offset))
 
     async def download():
+        # host announces a file it is about to stream, or asks where to resume one
+        if data.get("error"):
+            packet = dict()
+            packet["request_id"] = data["request_id"]
+            packet["ack"] = data["error"]
+            await reply(packet)
+            return
+
         datafolder = f"data/{host['id']}/files"
-        filename = data["filename"]
-        filepath = os.path.join(datafolder, filename)
+        filepath = os.path.join(datafolder, data["filename"])
+        partpath = f"{filepath}.part"
+
+        offset = await asyncio.to_thread(open_download, partpath, data.get("resume"))
+
+        transfers[data["request_id"]] = {
+            "filename": data["filename"],
+            "path": filepath,
+            "offset": offset
+        }
+
+        if data.get("resume"):
+            packet = dict()
+            packet["type"] = "download"
+            packet["request_id"] = data["request_id"]
+            packet["filename"] = data["filename"]
+            packet["offset"] = transfers[data["request_id"]]["offset"]
+            await websocket.send(json.dumps(packet))
+
+    async def chunk():
+        request_id, offset, payload, last, valid = protocol.unpack_chunk(message)
+        transfer = transfers.get(request_id)
+        if transfer is None:
+            return
+
+        if not valid or offset != transfer["offset"]:
+            # corrupted or out of order chunk, ask the host to resume from what we have
+            if not transfer.get("resuming"):
+                transfer["resuming"] = True
+                packet = dict()
+                packet["type"] = "download"
+                packet["request_id"] = request_id
+                packet["filename"] = transfer["filename"]
+                packet["offset"] = transfer["offset"]
+                await websocket.send(json.dumps(packet))
+            return
 
-        os.makedirs(datafolder, exist_ok=True)
+        transfer["resuming"] = False
+        partpath = f"{transfer['path']}.part"
+        await asyncio.to_thread(append_chunk, partpath, payload)
+        transfer["offset"] += len(payload)
 
-        with open(filepath, "wb") as f:
-            f.write(base64.b64decode(data["data"]))
+        if not last:
+            return
 
+        await asyncio.to_thread(os.replace, partpath, transfer["path"])
+        del transfers[request_id]
+
+        # let the host forget the transfer
         packet = dict()
-        packet["request_id"] = data["request_id"]
         packet["type"] = "download"
-        packet["filename"] = data["filename"]
-        await backend_server.send(json.dumps(packet))
+        packet["request_id"] = request_id
+        packet["filename"] = transfer["filename"]
+        packet["done"] = True
+        await websocket.send(json.dumps(packet))
+
+        packet = dict()
+        packet["request_id"] = request_id
+        packet["type"] = "download"
+        packet["filename"] = transfer["filename"]
+        await reply(packet)
+
+    async def output():
+        # part of a command's output, the command packet itself comes last
+        packet = dict()
+        packet["request_id"] = data["request_id"]
+        packet["stream"] = data["stream"]
+        packet["data"] = data["data"]
+        packet["more"] = True
+        await reply(packet, last=False)
 
     async def command():
         packet = dict()
         packet["request_id"] = data["request_id"]
         packet["out"], packet["err"] = data["out"], data["err"]
-        await backend_server.send(json.dumps(packet))
+        packet["code"], packet["status"] = data.get("code"), data.get("status")
+        await reply(packet)
+
+    async def cancel():
+        packet = dict()
+        packet["request_id"] = data["request_id"]
+        packet["cancelled"] = data["cancelled"]
+        await reply(packet)
 
     async def run():
         packet = dict()
         packet["request_id"] = data["request_id"]
         packet["ack"] = "run"
-        await backend_server.send(json.dumps(packet))
+        await reply(packet)
 
     async def move():
         packet = dict()
         packet["request_id"] = data["request_id"]
         packet["ack"] = "move"
-        await backend_server.send(json.dumps(packet))
+        await reply(packet)
 
     async def click():
         packet = dict()
         packet["request_id"] = data["request_id"]
         packet["ack"] = "click"
-        await backend_server.send(json.dumps(packet))
+        await reply(packet)
 
     async def write():
         packet = dict()
         packet["request_id"] = data["request_id"]
         packet["ack"] = "write"
-        await backend_server.send(json.dumps(packet))
+        await reply(packet)
 
     async def hotkey():
         packet = dict()
         packet["request_id"] = data["request_id"]
         packet["ack"] = "hotkey"
-        await backend_server.send(json.dumps(packet))
+        await reply(packet)
+
+    async def stream():
+        host_id, frame_message = host["id"], message
+        # the keyframe flag follows the frame kind in the header
+        snip_bytes.observe(len(message), kind="keyframe" if message[1] else "delta")
+
+        def job():
+            return ingest_frame(host_id, frame_message)
+
+        async def done(timestamp):
+            if host_id not in connected:
+                # went offline while the frame was queued or applied
+                forget_host(host_id)
+                return
+            if timestamp is None:
+                # ask for a fresh frame to apply deltas to
+                packet = dict()
+                packet["type"] = "snip"
+                packet["keyframe"] = True
+                await websocket.send(json.dumps(packet))
+                return
+            await publish("snip", host_id, timestamp=timestamp)
+
+        try:
+            submit_snip(host_id, job, done)
+        except asyncio.QueueFull:
+            # the delta is lost, the ones after it can not be applied until a keyframe arrives
+            snips_dropped.inc(kind="frame")
+            stale.add(host_id)
+
+    # maps binary frame kind to a function
+    binary_map = {
+        protocol.FRAME_SNIP: stream,
+        protocol.FRAME_CHUNK: chunk,
+    }
 
     func_map = {
         'setup': setup,
@@ -200,11 +817,16 @@ async def handler(websocket: websockets.ServerConnection):
         'echo': echo,
         'msg': msg,
         'hosts': hosts,
+        'rate': rate,
+        'input': input,
         'cmd': cmd,
+        'record': record,
         'snip': snip,
         "upload": upload,
         "download": download,
+        'output': output,
         'command': command,
+        'cancel': cancel,
         'run': run,
         'move': move,
         'click': click,
@@ -214,18 +836,30 @@ async def handler(websocket: websockets.ServerConnection):
 
     async for message in websocket:
         try:
+            if isinstance(message, bytes):
+                # binary frames are only accepted from authenticated hosts
+                if host["auth"] and message[:1] and message[0] in binary_map:
+                    packets_received.inc(type=f"binary:{message[0]}")
+                    await binary_map[message[0]]()
+                continue
             data = json.loads(message)
+            kind = data.get("type") if isinstance(data, dict) else None
+            # only known types are counted, anything else would add a metric series per packet
+            if not isinstance(kind, str) or kind not in func_map:
+                print("Invalid method")
+                continue
             if not host["auth"]:
                 if (datetime.datetime.now(datetime.UTC) - host["opentime"]).total_seconds() < 30:
-                    if data['type'] == "setup" or data['type'] == "hello":
-                        await func_map[data['type']]()
+                    if kind == "setup" or kind == "hello":
+                        await func_map[kind]()
                     else:
                         print("Invalid method")
                 else:
                     print("Closing unauthorized connection")
                     await websocket.close()
             else:
-                await func_map[data['type']]()
+                packets_received.inc(type=kind)
+                await func_map[kind]()
         except json.JSONDecodeError:
             print("Invalid JSON data")
         except KeyError as e:
@@ -234,20 +868,53 @@ async def handler(websocket: websockets.ServerConnection):
     if host["auth"]:
         if host["id"] == "backend":
             print("Connection Lost with backend")
-        else:
+            backends.discard(websocket)
+            for request_id in [_ for _, backend in routes.items() if backend is websocket]:
+                del routes[request_id]
+            for channel in [_ for _, backend in input_channels.items() if backend is websocket]:
+                del input_channels[channel]
+            # viewers on that webserver are gone too
+            for host_id in [_ for _, sessions in watchers.items() if websocket in sessions]:
+                await set_watch(websocket, host_id, None)
+        elif connected.get(host['id']) is websocket:
+            # an older connection closing after the host reconnected must not mark it offline
             del connected[host['id']]
+            forget_host(host['id'])
             await db_update()
+            await publish("offline", host["id"])
             print("Goodbye")
 
 
-async def main():
-    async with websockets.serve(handler, "0.0.0.0", 8765, max_size=100*1024*1024):
-        print(f"Listening to connection requests")
-        await asyncio.Future()
+async def main(port):
+    global node_url
+    node_url = os.getenv("HOSTSERVER_URL", f"ws://localhost:{port}")
+    if node_url not in cluster.ring.nodes:
+        print(f"{node_url} is not in HOSTSERVER_NODES, accepting every host")
+    await load_known_hosts()
+    await load_recordings()
+    flush_task = asyncio.create_task(flush_last_seen_periodically())
+    events_task = asyncio.create_task(flush_events_periodically())
+    prune_task = asyncio.create_task(prune_snips_periodically())
+    lag_task = asyncio.create_task(metrics.watch_loop_lag())
+    start_snip_workers()
+    try:
+        async with websockets.serve(handler, "0.0.0.0", port, max_size=100*1024*1024,
+                                    process_request=process_request):
+            print(f"Listening to connection requests")
+            await asyncio.Future()
+    finally:
+        # write out whatever is still buffered before exiting
+        flush_task.cancel()
+        events_task.cancel()
+        prune_task.cancel()
+        lag_task.cancel()
+        await flush_last_seen()
+        await flush_events()
 
 
 if __name__ == '__main__':
     try:
-        asyncio.run(main())
+        # several nodes can run on one machine, one per port
+        asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 8765))
     except KeyboardInterrupt:
         pass
@@ -0,0 +1,149 @@
+import asyncio
+import time
+from contextlib import contextmanager
+
+# counters, gauges and histograms of one process, rendered in the prometheus text format
+# every process has its own registry, webserver and hostserver serve it on /metrics, host dumps it to a file
+
+# seconds, from a relayed click to a file transfer
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# bytes, from a small delta to a full screen png
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+# seconds between checks of the event loop
+LAG_INTERVAL = 0.5
+
+registry = []
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def escape(value):
+    # label values are quoted, a quote or newline in one would end the sample early
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        # label key -> value
+        self.values = dict()
+        registry.append(self)
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, key, value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, value in self.samples():
+            lines.append(f"{name}{format_labels(key)} {value:g}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    # func is called on every scrape, for values that already live somewhere else like len(connected)
+    # it returns a number, or a dict of label value -> number for a gauge with one label
+    kind = "gauge"
+
+    def __init__(self, name, help, func=None, label=None):
+        super().__init__(name, help)
+        self.func = func
+        self.label = label
+
+    def set(self, value, **labels):
+        self.values[label_key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        if self.func is None:
+            yield from super().samples()
+            return
+        value = self.func()
+        if isinstance(value, dict):
+            for label, _ in value.items():
+                yield self.name, ((self.label, label),), _
+        else:
+            yield self.name, (), value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = label_key(labels)
+        series = self.values.get(key)
+        if series is None:
+            # count per bucket, then sum and count
+            series = self.values[key] = [[0] * len(self.buckets), 0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{format_labels(key, [('le', f'{bound:g}')])} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels(key, [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {total:g}")
+            lines.append(f"{self.name}_count{format_labels(key)} {count}")
+        return lines
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+loop_lag = Histogram("event_loop_lag_seconds", "How late the event loop woke up from a sleep")
+
+
+async def watch_loop_lag(interval=LAG_INTERVAL):
+    # anything blocking the loop shows up as a late wake up, a busy loop is the first thing to find
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        loop_lag.observe(max(0.0, loop.time() - start - interval))
@@ -0,0 +1,142 @@
+import asyncio
+import os
+import struct
+import zlib
+from uuid import UUID
+
+from websockets import ConnectionClosed
+
+# every packet on the host <> hostserver socket is JSON text
+# except binary frames, whose first byte names the frame kind
+FRAME_SNIP = 1
+FRAME_CHUNK = 2
+
+# snip frame: kind, keyframe flag, screen width, screen height, tile size, tile count
+SNIP_HEADER = struct.Struct("!BBHHHH")
+# followed by one of these per tile: x, y, length of the png that follows
+TILE_HEADER = struct.Struct("!HHI")
+
+# screen is diffed in squares of this many pixels
+TILE_SIZE = 64
+
+# chunk frame: kind, request id as 16 uuid bytes, offset in file, length, crc32 of data, flags
+CHUNK_HEADER = struct.Struct("!B16sQIIB")
+# flag set on the final chunk of a file
+CHUNK_LAST = 1
+
+# seconds between frames of a host nobody is watching
+IDLE_INTERVAL = 300
+
+# files are streamed in pieces of this size so no hop ever holds a whole file
+CHUNK_SIZE = 512 * 1024
+
+
+# input events are short lists, the first item names the event
+# ["m", dx, dy] relative move, ["M", x, y] absolute move, ["c", x, y, button, clicks] click,
+# ["w", text, speed, enter] write, ["h", keys] hotkey, ["k", key] key press
+# argument types of each event, positions and counts are whole numbers
+INPUT_ARGS = {
+    "m": (int, int),
+    "M": (int, int),
+    "c": (int, int, str, int),
+    "w": (str, (int, float), bool),
+    "h": (str,),
+    "k": (str,),
+}
+
+
+def valid_input(event):
+    # events come from browsers, one the host can not apply must not get that far
+    if not isinstance(event, list) or not event or event[0] not in INPUT_ARGS:
+        return False
+    args = INPUT_ARGS[event[0]]
+    if len(event) != len(args) + 1:
+        return False
+    # json true and false are ints to isinstance
+    return all(isinstance(value, kind) and (kind is bool or not isinstance(value, bool))
+               for value, kind in zip(event[1:], args))
+
+
+def coalesce(events):
+    # consecutive relative moves add up, of consecutive absolute moves only the last one matters
+    merged = []
+    for event in events:
+        if merged and event[0] == merged[-1][0] == "m":
+            merged[-1] = ["m", merged[-1][1] + event[1], merged[-1][2] + event[2]]
+        elif merged and event[0] == merged[-1][0] == "M":
+            merged[-1] = event
+        else:
+            merged.append(event)
+    return merged
+
+
+def pack_snip(keyframe, size, tiles):
+    # tiles is a list of (x, y, png bytes)
+    parts = [SNIP_HEADER.pack(FRAME_SNIP, keyframe, size[0], size[1], TILE_SIZE, len(tiles))]
+    for x, y, data in tiles:
+        parts.append(TILE_HEADER.pack(x, y, len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+
+def unpack_snip(message):
+    _, keyframe, width, height, _, count = SNIP_HEADER.unpack_from(message)
+    # tiles are sliced out of the message without copying
+    view = memoryview(message)
+    offset = SNIP_HEADER.size
+    tiles = []
+    for _ in range(count):
+        x, y, length = TILE_HEADER.unpack_from(message, offset)
+        offset += TILE_HEADER.size
+        tiles.append((x, y, view[offset:offset + length]))
+        offset += length
+    return bool(keyframe), (width, height), tiles
+
+
+def pack_chunk(request_id, offset, data, last, crc=None):
+    # crc can be passed in when the same data is sent to many hosts
+    header = CHUNK_HEADER.pack(FRAME_CHUNK, UUID(request_id).bytes, offset, len(data),
+                               zlib.crc32(data) if crc is None else crc, CHUNK_LAST if last else 0)
+    return header + data
+
+
+def unpack_chunk(message):
+    _, request_id, offset, length, crc, flags = CHUNK_HEADER.unpack_from(message)
+    data = memoryview(message)[CHUNK_HEADER.size:]
+    # a chunk is only valid if it arrived whole and its checksum matches
+    valid = len(data) == length and zlib.crc32(data) == crc
+    return str(UUID(bytes=request_id)), offset, data, bool(flags & CHUNK_LAST), valid
+
+
+async def send_file(websocket, request_id, filepath, offset=0):
+    # streams a file as chunk frames starting at offset
+    # returns True once the last chunk has been sent
+    try:
+        with open(filepath, mode="rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            f.seek(offset)
+            while True:
+                data = f.read(CHUNK_SIZE)
+                last = offset + len(data) >= size
+                await websocket.send(pack_chunk(request_id, offset, data, last))
+                offset += len(data)
+                if last:
+                    return True
+    except ConnectionClosed:
+        # the receiver resumes from its own offset after reconnecting
+        return False
+
+
+def start_stream(streams, request_id, coro):
+    # one stream per transfer, a resume replaces the stream still running
+    previous = streams.get(request_id)
+    if previous is not None:
+        previous.cancel()
+    task = asyncio.create_task(coro)
+    streams[request_id] = task
+
+    def done(_):
+        if streams.get(request_id) is task:
+            del streams[request_id]
+
+    task.add_done_callback(done)
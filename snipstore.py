@@ -0,0 +1,193 @@
+import itertools
+import json
+import os
+import struct
+import time
+
+# snip history of every host as an append-only frame log, written by hostserver and read by webserver
+# data/{host_id}/snips/{start}.frames holds encoded frames back to back, {start}.index one fixed size record per frame
+# a segment covers SEGMENT_MS from a multiple of SEGMENT_MS, so the segment of any moment is known without listing files
+# records are in timestamp order, the latest frame is the last record and any moment is a binary search away
+# {start}.events holds the input and commands relayed to the host meanwhile, one json line each, for replays
+
+SEGMENT_MS = 10 * 60 * 1000
+# seconds of history kept per host, older segments are deleted whole
+RETENTION = int(os.getenv("SNIP_RETENTION", 3 * 3600))
+# timestamp in ms, offset in the frames file, length, format
+INDEX_RECORD = struct.Struct("!QQIB3x")
+FORMATS = ("png", "webp")
+
+
+def folder(host_id):
+    return os.path.join("data", host_id, "snips")
+
+
+def segment_of(timestamp):
+    return timestamp - timestamp % SEGMENT_MS
+
+
+def segment_paths(host_id, segment):
+    base = os.path.join(folder(host_id), str(segment))
+    return f"{base}.frames", f"{base}.index", f"{base}.events"
+
+
+def segments(host_id, start, end):
+    # segments holding anything between start and end, oldest first
+    try:
+        names = os.listdir(folder(host_id))
+    except FileNotFoundError:
+        return []
+    found = {int(_.split(".")[0]) for _ in names}
+    return sorted(_ for _ in found if segment_of(start) <= _ <= end)
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+class SnipLog:
+    # writer for one host, only ever used from the snip worker that host is assigned to
+    # files are opened per frame, a thousand hosts must not hold two thousand files open
+    # keep is the list of [start, end] of the host's recordings, shared with hostserver, end is None while recording
+
+    def __init__(self, host_id, keep=()):
+        self.host_id = host_id
+        self.keep = keep
+        os.makedirs(folder(host_id), exist_ok=True)
+        self.segment = None
+        self.last = 0
+
+    def append(self, data, fmt):
+        # returns the timestamp the frame is stored under, unique per host
+        timestamp = max(now_ms(), self.last + 1)
+        if segment_of(timestamp) != self.segment:
+            self.roll(segment_of(timestamp))
+        frames_path, index_path, _ = segment_paths(self.host_id, self.segment)
+        with open(frames_path, "ab") as f:
+            offset = f.tell()
+            f.write(data)
+        # the record goes in only once the frame is written, readers never see half a frame
+        with open(index_path, "ab") as f:
+            f.write(INDEX_RECORD.pack(timestamp, offset, len(data), FORMATS.index(fmt)))
+        self.last = timestamp
+        return timestamp
+
+    def roll(self, segment):
+        index_path = segment_paths(self.host_id, segment)[1]
+        # a record cut short by a crash would shift every record after it
+        if os.path.exists(index_path) and os.path.getsize(index_path) % INDEX_RECORD.size:
+            size = os.path.getsize(index_path)
+            os.truncate(index_path, size - size % INDEX_RECORD.size)
+        self.segment = segment
+        self.prune(segment)
+
+    def kept(self, segment):
+        # a segment some recording overlaps stays until the recording is deleted
+        return any(start < segment + SEGMENT_MS and (end is None or end >= segment) for start, end in self.keep)
+
+    def prune(self, now):
+        # listed every time, events are written from another thread and may start segments of their own
+        cutoff = now - RETENTION * 1000
+        for segment in segments(self.host_id, 0, cutoff - SEGMENT_MS):
+            if self.kept(segment):
+                continue
+            for path in segment_paths(self.host_id, segment):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+def read_record(f, i):
+    f.seek(i * INDEX_RECORD.size)
+    return INDEX_RECORD.unpack(f.read(INDEX_RECORD.size))
+
+
+def find(host_id, timestamp=None):
+    # newest frame at or before timestamp as (timestamp, segment, offset, length, format)
+    # None if the host has no frame within the retention before it
+    # nothing is stored after now, a later timestamp would only walk back through missing segments
+    timestamp = now_ms() if timestamp is None else min(timestamp, now_ms())
+    segment = segment_of(timestamp)
+    oldest = segment_of(timestamp - RETENTION * 1000)
+    while segment >= oldest:
+        try:
+            f = open(segment_paths(host_id, segment)[1], "rb")
+        except FileNotFoundError:
+            segment -= SEGMENT_MS
+            continue
+        with f:
+            count = os.fstat(f.fileno()).st_size // INDEX_RECORD.size
+            # the latest frame is asked for far more often than any other
+            if count and read_record(f, count - 1)[0] <= timestamp:
+                low = count
+            else:
+                low, high = 0, count
+                while low < high:
+                    middle = (low + high) // 2
+                    if read_record(f, middle)[0] <= timestamp:
+                        low = middle + 1
+                    else:
+                        high = middle
+            if low:
+                stamp, offset, length, fmt = read_record(f, low - 1)
+                return stamp, segment, offset, length, FORMATS[fmt]
+        segment -= SEGMENT_MS
+    return None
+
+
+def read_frame(host_id, frame):
+    # bytes of a frame returned by find
+    _, segment, offset, length, _ = frame
+    with open(segment_paths(host_id, segment)[0], "rb") as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+def frames(host_id, start, end):
+    # frames between start and end as returned by find, oldest first, read one segment at a time
+    for segment in segments(host_id, start, end):
+        try:
+            with open(segment_paths(host_id, segment)[1], "rb") as f:
+                records = f.read()
+        except FileNotFoundError:
+            continue
+        records = records[:len(records) - len(records) % INDEX_RECORD.size]
+        for stamp, offset, length, fmt in INDEX_RECORD.iter_unpack(records):
+            if stamp > end:
+                return
+            if stamp >= start:
+                yield stamp, segment, offset, length, FORMATS[fmt]
+
+
+def timestamps(host_id, start, end, limit):
+    # timestamps of the frames between start and end, oldest first, for scrubbing through the history
+    return [_[0] for _ in itertools.islice(frames(host_id, start, end), limit)]
+
+
+def append_events(host_id, events):
+    # events relayed to a host as [timestamp, kind, detail] in timestamp order
+    os.makedirs(folder(host_id), exist_ok=True)
+    for segment, group in itertools.groupby(events, lambda _: segment_of(_[0])):
+        with open(segment_paths(host_id, segment)[2], "a") as f:
+            f.writelines(json.dumps(_, separators=(",", ":")) + "\n" for _ in group)
+
+
+def read_events(host_id, start, end):
+    # events between start and end, oldest first
+    result = []
+    for segment in segments(host_id, start, end):
+        try:
+            with open(segment_paths(host_id, segment)[2]) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            continue
+        for line in lines:
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                # cut short by a crash
+                continue
+            if start <= event[0] <= end:
+                result.append(event)
+    return result
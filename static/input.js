@@ -0,0 +1,81 @@
+// low latency mouse and keyboard channel to one host
+// events are batched for a few milliseconds, consecutive moves are merged into one
+// every event gets a sequence number and the host acks the last one it applied
+const INPUT_BATCH_MS = 15
+// events sent but not acked yet, past this moves keep merging instead of queueing on a slow link
+const INPUT_WINDOW = 32
+// ms a full window waits for an ack, acks lost to a host reconnecting never arrive
+const INPUT_ACK_TIMEOUT = 2000
+
+function input_channel(uuid) {
+    let channel = {pending: [], sent: 0, acked: 0, timer: null, stall: null, socket: null}
+
+    function connect() {
+        let socket = new WebSocket(IP.replace(/^http/, "ws") + "/host/" + uuid + "/input")
+        channel.socket = socket
+        socket.onopen = function () {
+            flush()
+        }
+        socket.onmessage = function (message) {
+            let data = JSON.parse(message.data)
+            if (data.ack !== undefined) {
+                channel.acked = Math.max(channel.acked, data.ack)
+                flush()
+            } else if (data.error) {
+                // the batch was dropped and will never be acked, its events are lost like on a reconnect
+                console.log(data.error)
+                channel.acked = channel.sent
+                flush()
+            }
+        }
+        socket.onclose = function () {
+            // events that were never acked are dropped, repeating a click is worse than losing it
+            channel.acked = channel.sent
+            setTimeout(connect, 1000)
+        }
+    }
+
+    function flush() {
+        channel.timer = null
+        if (!channel.pending.length || channel.socket.readyState !== WebSocket.OPEN) {
+            return
+        }
+        if (channel.sent - channel.acked >= INPUT_WINDOW) {
+            // sent again when the next ack arrives, or given up on if none comes
+            if (!channel.stall) {
+                let acked = channel.acked
+                channel.stall = setTimeout(function () {
+                    channel.stall = null
+                    if (channel.acked === acked) {
+                        channel.acked = channel.sent
+                    }
+                    flush()
+                }, INPUT_ACK_TIMEOUT)
+            }
+            return
+        }
+        let events = channel.pending
+        channel.pending = []
+        channel.socket.send(JSON.stringify({seq: channel.sent + 1, events: events}))
+        channel.sent += events.length
+    }
+
+    // ["m", dx, dy], ["M", x, y], ["c", x, y, button, clicks], ["w", text, speed, enter], ["h", keys], ["k", key]
+    channel.send = function (event) {
+        let last = channel.pending[channel.pending.length - 1]
+        if (last && last[0] === "m" && event[0] === "m") {
+            last[1] += event[1]
+            last[2] += event[2]
+        } else if (last && last[0] === "M" && event[0] === "M") {
+            channel.pending[channel.pending.length - 1] = event
+        } else {
+            channel.pending.push(event)
+        }
+        if (!channel.timer) {
+            channel.timer = setTimeout(flush, INPUT_BATCH_MS)
+        }
+    }
+
+    connect()
+    return channel
+}
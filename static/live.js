@@ -0,0 +1,37 @@
+// live event channel shared by the dashboard pages
+// the server pushes host presence, name and new snip events as they happen
+// handler is called with every event, and with {event: "resync"} after a reconnect
+function live(handler) {
+    let socket = new WebSocket(IP.replace(/^http/, "ws") + "/api/live")
+    let opened = false
+    live.socket = socket
+
+    socket.onopen = function () {
+        if (live.watching) {
+            socket.send(JSON.stringify(live.watching))
+        }
+        // anything may have changed while the channel was down
+        if (live.connected) {
+            handler({event: "resync"})
+        }
+        live.connected = opened = true
+    }
+    socket.onmessage = function (message) {
+        handler(JSON.parse(message.data))
+    }
+    socket.onclose = function () {
+        setTimeout(function () {
+            live(handler)
+        }, opened ? 1000 : 5000)
+    }
+    return socket
+}
+
+// tells the server which hosts this page shows, level is "grid" or "control"
+// hosts nobody watches send frames rarely, watched ones as fast as their level asks
+function watch(hosts, level) {
+    live.watching = {type: "watch", hosts: hosts, level: level}
+    if (live.socket && live.socket.readyState === WebSocket.OPEN) {
+        live.socket.send(JSON.stringify(live.watching))
+    }
+}
@@ -1,100 +1,305 @@
 import asyncio
-import glob
+import base64
+import io
 
 import timeago
 import datetime
 import json
+import math
 import os
-import threading
+import struct
+import time
+from collections import OrderedDict
 from contextlib import asynccontextmanager
+from functools import partial
+from email.utils import formatdate, parsedate_to_datetime
 from datetime import timedelta
 from typing import Optional, Dict
 from uuid import uuid4
 
-import pymongo
-import websockets
 from PIL import Image
 from dotenv import load_dotenv
 from jose import jwt, JWTError
 
 import uvicorn
-from fastapi import FastAPI, Request, Depends, HTTPException, status, UploadFile, File
+from fastapi import FastAPI, Request, Depends, HTTPException, status, UploadFile, File, WebSocket, WebSocketDisconnect
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2
-from fastapi.responses import HTMLResponse, FileResponse, Response, RedirectResponse
+from fastapi.responses import HTMLResponse, FileResponse, Response, RedirectResponse, StreamingResponse
 from fastapi.security.utils import get_authorization_scheme_param
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.openapi.models import OAuthFlows as OAuthFlowsModel
 
+import blobs
+import cluster
+import database
+import hostlink
+import metrics
+import protocol
+import snipstore
+
 load_dotenv()
-IP = "ws://localhost:8765"
-db = pymongo.MongoClient(os.getenv("CONN_STRING"))["remote"]
 SECRET_KEY = os.getenv("SECRET_KEY")
-websocket: websockets.ClientConnection
-request_mapping = {}
-
-
-def generate_request_id():
-    request_id = str(uuid4())
-    while request_id in request_mapping.keys():
-        request_id = str(uuid4())
-    return request_id
+# seconds to wait for a reply before giving up on a request
+REQUEST_TIMEOUT = 30
+# connections to hostserver per lane, bulk carries commands whose packets or replies can be large
+LINK_LANES = {
+    "control": int(os.getenv("CONTROL_LINKS", 2)),
+    "bulk": int(os.getenv("BULK_LINKS", 1)),
+}
+BULK_COMMANDS = {"upload", "download", "snip"}
+# commands relay metrics are labelled with, anything else a form sends is counted as "other"
+RELAY_COMMANDS = {"snip", "upload", "download", "command", "cancel", "run", "move", "click", "write", "hotkey",
+                  "record"}
+# seconds a shell command may run on a host before it is killed
+COMMAND_TIMEOUT = 300
+# seconds on top of a command's own timeout for its last reply to arrive
+COMMAND_GRACE = 5
+# seconds a group command waits for its slowest host unless the request asks otherwise
+GROUP_DEADLINE = 30
+# file transfers only reply after their last chunk, large files on slow links take a while
+TRANSFER_COMMANDS = {"upload", "download"}
+TRANSFER_TIMEOUT = int(os.getenv("TRANSFER_TIMEOUT", 3600))
+# hosts connected to hostserver, kept current by online and offline events
+online_hosts = set()
+# timestamp of the newest snip per host, announced by snip events
+latest_snips = dict()
+# (uuid, timestamp, scale) -> jpeg bytes, least recently used first
+thumbnails = OrderedDict()
+# renditions kept in memory, three per frame
+THUMBNAIL_CACHE_SIZE = 768
+# width of a host's tile in a group mosaic
+MOSAIC_TILE_WIDTH = 320
+# bumped on every snip event, a mosaic only carries tiles newer than the version the browser has
+# starts from the clock so versions keep growing across restarts
+snip_version = time.time_ns()
+# uuid -> snip_version of its latest snip
+snip_versions = dict()
+# (uuid, timestamp) -> task rendering that frame, so concurrent requests render it once
+rendering = dict()
+# most snip timestamps one timeline request returns
+TIMELINE_LIMIT = 5000
+# fastest a replay can be played back
+REPLAY_MAX_SPEED = 64
+# longest pause of a replay in seconds, idle stretches are cut short
+REPLAY_MAX_GAP = 2
+# one queue per browser subscribed to /api/live
+subscribers = set()
+# events a browser may fall behind by before its oldest ones are dropped
+SUBSCRIBER_QUEUE_SIZE = 100
+# seconds between frames a host is asked for, by how closely a browser is looking at it
+WATCH_INTERVALS = {"grid": 5, "control": 0.5}
+# queue of each /api/live browser -> {uuid: seconds between frames it wants}
+watching = dict()
+# uuid -> interval last sent to hostserver, hosts nobody watches are left out
+capture_intervals = dict()
+# input channel -> control page sending input over it
+input_channels = dict()
+# scrapers of /metrics send it as a bearer token, /metrics is open when unset
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+# verified token -> (user, time the entry stops being trusted), least recently used first
+verified_tokens = OrderedDict()
+VERIFIED_TOKENS_SIZE = 10000
+# seconds a user record is reused without asking mongo, changes made by another webserver show up after this
+VERIFIED_TOKEN_TTL = 60
+
+relay_seconds = metrics.Histogram("webserver_relay_seconds", "Round trip of a request to a host, by command")
+relay_errors = metrics.Counter("webserver_relay_errors_total", "Requests to hosts that failed, by command and reason")
+events_received = metrics.Counter("webserver_events_total", "Events pushed by hostserver, by event")
+token_lookups = metrics.Counter("webserver_token_lookups_total", "Tokens checked, by whether they were cached")
+metrics.Gauge("webserver_verified_tokens", "Verified tokens cached in memory", lambda: len(verified_tokens))
+metrics.Gauge("webserver_online_hosts", "Hosts online on any node", lambda: len(online_hosts))
+metrics.Gauge("webserver_live_subscribers", "Browsers subscribed to /api/live", lambda: len(subscribers))
+metrics.Gauge("webserver_input_channels", "Control pages sending input", lambda: len(input_channels))
+metrics.Gauge("webserver_thumbnails", "Thumbnails cached in memory", lambda: len(thumbnails))
+metrics.Gauge("webserver_link_pending", "Requests waiting for a reply, by hostserver node",
+              lambda: {node: sum(len(_.pending) for _ in pool.links) for node, pool in pools.items()}, "node")
+metrics.Gauge("webserver_link_outbound", "Packets waiting to be written, by hostserver node",
+              lambda: {node: sum(_.outbound.qsize() for _ in pool.links) for node, pool in pools.items()}, "node")
+metrics.Gauge("webserver_link_connected", "Links to hostserver that are up, by hostserver node",
+              lambda: {node: sum(_.connected for _ in pool.links) for node, pool in pools.items()}, "node")
+
+
+async def send_request(packet, timeout=REQUEST_TIMEOUT):
+    # sends a packet to hostserver and waits for the reply with the same request_id
+    if packet.get("cmd") == "command":
+        return await collect_output(packet, timeout)
+    # the host is only reachable through the node that owns it
+    pool = pools[cluster.ring.node_for(packet["uuid"])]
+    lane = "bulk" if packet.get("cmd") in BULK_COMMANDS else "control"
+    # cmd comes from the request, a label per value would add a metric series per request
+    cmd = packet.get("cmd", packet["type"])
+    cmd = cmd if cmd in RELAY_COMMANDS else "other"
+    try:
+        with relay_seconds.time(cmd=cmd):
+            return await pool.request(packet, timeout, lane)
+    except TimeoutError:
+        relay_errors.inc(cmd=cmd, reason="timeout")
+        raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail="Host did not respond in time")
+    except hostlink.LinkUnavailable as e:
+        relay_errors.inc(cmd=cmd, reason="unavailable")
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+
+
+async def stream_request(packet, timeout):
+    # a shell command, yields its output as the host produces it and the command packet last
+    # the host kills the command once timeout runs out
+    packet["timeout"] = timeout
+    pool = pools[cluster.ring.node_for(packet["uuid"])]
+    try:
+        with relay_seconds.time(cmd="command"):
+            async for data in pool.stream(packet, timeout + COMMAND_GRACE, "control"):
+                yield data
+    except TimeoutError:
+        relay_errors.inc(cmd="command", reason="timeout")
+        raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail="Host did not respond in time")
+    except hostlink.LinkUnavailable as e:
+        relay_errors.inc(cmd="command", reason="unavailable")
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+
+
+async def collect_output(packet, timeout):
+    # streamed output joined into one reply, for callers that want it whole
+    output = {"out": [], "err": []}
+    async for data in stream_request(packet, timeout):
+        if data.get("more"):
+            output[data["stream"]].append(data["data"])
+            continue
+        data["out"], data["err"] = "".join(output["out"]), "".join(output["err"])
+        return data
+
+
+def broadcast(packet):
+    for queue in subscribers:
+        if queue.full():
+            # events only tell dashboards what to reload, a slow browser can lose old ones
+            queue.get_nowait()
+        queue.put_nowait(packet)
+
+
+def publish(event, uuid):
+    packet = dict()
+    packet["type"] = "event"
+    packet["event"] = event
+    packet["uuid"] = uuid
+    broadcast(packet)
+
+
+def on_event(packet):
+    global snip_version
+    events_received.inc(event=packet["event"])
+    if packet["event"] == "online":
+        online_hosts.add(packet["uuid"])
+    elif packet["event"] == "offline":
+        online_hosts.discard(packet["uuid"])
+    elif packet["event"] == "snip":
+        latest_snips[packet["uuid"]] = packet["timestamp"]
+        snip_version += 1
+        snip_versions[packet["uuid"]] = snip_version
+        # render thumbnails now if someone is watching, so their requests find them ready
+        if subscribers:
+            asyncio.create_task(prerender(packet["uuid"]))
+    broadcast(packet)
+
+
+def set_online_hosts(node, hosts):
+    # replaces the hosts of one node, the other nodes keep theirs
+    online_hosts.difference_update([_ for _ in online_hosts if cluster.ring.node_for(_) == node])
+    online_hosts.update(hosts)
+    # presence may have changed in any way, dashboards reload everything
+    packet = dict()
+    packet["type"] = "event"
+    packet["event"] = "resync"
+    broadcast(packet)
 
 
-async def request_message(request_id):
-    while not request_mapping.get(request_id, 0):
-        await asyncio.sleep(0.1)
-    response = request_mapping[request_id]
-    del request_mapping[request_id]
-    return response
+def wanted_interval(uuid):
+    intervals = [_[uuid] for _ in watching.values() if uuid in _]
+    return min(intervals) if intervals else None
 
 
-async def listen():
-    async for message in websocket:
-        try:
-            data = json.loads(message)
-            print(data)
-        except Exception as e:
-            print(e)
+async def send_rates(node, hosts):
+    packet = dict()
+    packet["type"] = "rate"
+    packet["hosts"] = hosts
+    try:
+        # hostserver keeps rates per session, so they always go over the same link
+        await pools[node].events.send(packet)
+    except hostlink.LinkUnavailable:
+        # sent again by resync once the node is back
+        pass
+
+
+async def update_capture(uuids):
+    # tells the nodes about hosts whose wanted rate changed
+    changes = dict()
+    for uuid in uuids:
+        interval = wanted_interval(uuid)
+        if capture_intervals.get(uuid) == interval:
+            continue
+        if interval is None:
+            del capture_intervals[uuid]
+        else:
+            capture_intervals[uuid] = interval
+        changes.setdefault(cluster.ring.node_for(uuid), {})[uuid] = interval
+    for node, hosts in changes.items():
+        await send_rates(node, hosts)
+
+
+def on_packet(data):
+    # host presence and new snips pushed by hostserver
+    if data.get("type") == "event":
+        on_event(data)
+    # acks for input sent by a control page
+    elif data.get("type") == "input":
+        browser = input_channels.get(data["channel"])
+        if browser is not None:
+            del data["type"], data["channel"]
+            asyncio.create_task(browser.send_json(data))
+
+
+async def resync(node):
+    # full snapshot of connected hosts, events keep it current from here on
+    # events that arrive before the reply are older than the snapshot and can be skipped
+    packet = dict()
+    packet["type"] = "hosts"
+    try:
+        # asked on the events link itself, so no event can overtake the snapshot
+        data = await pools[node].events.request(packet, REQUEST_TIMEOUT)
+    except (TimeoutError, hostlink.LinkUnavailable) as e:
+        print(e)
+        return
+    set_online_hosts(node, data["hosts"])
+    # a restarted node knows nothing about who is watching
+    hosts = {uuid: interval for uuid, interval in capture_intervals.items() if cluster.ring.node_for(uuid) == node}
+    if hosts:
+        await send_rates(node, hosts)
 
 
-async def auth():
-    packet = dict()
-    print(f"Connecting with Host Server")
-    packet['type'] = "hello"
-    packet['host_id'] = "backend"
-    await websocket.send(json.dumps(packet))
-    async for message in websocket:
-        print(message)
-        break
+def on_disconnect(node):
+    # nothing is known about the hosts of a node while disconnected from it
+    set_online_hosts(node, [])
 
 
-async def initiate_websocket():
-    global websocket
-    while True:
-        try:
-            async with websockets.connect(IP) as websocket:
-                await auth()
-                listen_task = asyncio.create_task(listen())
-                await asyncio.gather(listen_task)
-        except Exception as e:
-            print(e)
-            websocket = None
-            print("Reconnecting in 10s")
-            await asyncio.sleep(10)
+# hostserver node url -> pool of links to it
+pools = {node: hostlink.HostServerPool(node, LINK_LANES, on_packet=on_packet,
+                                       on_connect=partial(resync, node), on_disconnect=partial(on_disconnect, node))
+         for node in cluster.NODES}
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global websocket
-    websocket_thread = threading.Thread(target=asyncio.run, args=(initiate_websocket(),))
-    websocket_thread.start()
+    for pool in pools.values():
+        pool.start()
+    lag_task = asyncio.create_task(metrics.watch_loop_lag())
+    prune_task = asyncio.create_task(prune_blobs_periodically())
 
     yield
 
-    await websocket.close()
-    websocket_thread.join()
+    lag_task.cancel()
+    prune_task.cancel()
+    await asyncio.gather(*[pool.stop() for pool in pools.values()])
 
 
 app = FastAPI(lifespan=lifespan)
@@ -144,7 +349,7 @@ async def login_user(request: Request):
         try:
             response = RedirectResponse(f"/hosts", status_code=status.HTTP_303_SEE_OTHER)
             # noinspection PyTypeChecker
-            login_for_access_token(response=response, form_data=form)
+            await login_for_access_token(response=response, form_data=form)
             return response
         except HTTPException:
             return templates.TemplateResponse(request=request, name="login.html")
@@ -163,13 +368,13 @@ async def requires_login(request: Request, _: Exception):
     return RedirectResponse(f"/login")
 
 
-def get_user(username):
-    user = db['users'].find_one({'username': username}, {'_id': 0})
+async def get_user(username):
+    user = await database.find_one('users', {'username': username}, {'_id': 0})
     return user
 
 
-def authenticate_user(username, password):
-    user = get_user(username)
+async def authenticate_user(username, password):
+    user = await get_user(username)
     if user is None or user["password"] != password:
         return False
     return user
@@ -187,8 +392,8 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
 
 
 @app.post("/token")
-def login_for_access_token(response: Response, form_data: OAuth2PasswordRequestForm = Depends()):
-    user = authenticate_user(form_data.username, form_data.password)
+async def login_for_access_token(response: Response, form_data: OAuth2PasswordRequestForm = Depends()):
+    user = await authenticate_user(form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -231,7 +436,19 @@ class OAuth2PasswordBearerWithCookie(OAuth2):
 oauth2_scheme = OAuth2PasswordBearerWithCookie(tokenUrl="/login/token")
 
 
-def get_current_user_from_token(token: str = Depends(oauth2_scheme)):
+async def get_current_user_from_token(token: str = Depends(oauth2_scheme)):
+    return await get_user_from_token(token)
+
+
+async def get_user_from_token(token):
+    # every request and dashboard poll comes through here, a token seen recently skips jwt and mongo
+    cached = verified_tokens.get(token)
+    if cached is not None and cached[1] > time.time():
+        verified_tokens.move_to_end(token)
+        token_lookups.inc(result="hit")
+        return cached[0]
+    token_lookups.inc(result="miss")
+
     try:
         payload = jwt.decode(
             token, SECRET_KEY, algorithms='HS256'
@@ -240,16 +457,53 @@ def get_current_user_from_token(token: str = Depends(oauth2_scheme)):
         if username is None:
             raise RequiresLogin
     except JWTError:
+        verified_tokens.pop(token, None)
         raise RequiresLogin
-    user = get_user(username=username)
+    user = await get_user(username=username)
     if user is None:
+        verified_tokens.pop(token, None)
         raise RequiresLogin
+
+    # never trusted past the token's own expiry, a token without one does not expire
+    verified_tokens[token] = (user, min(time.time() + VERIFIED_TOKEN_TTL, payload.get("exp", math.inf)))
+    verified_tokens.move_to_end(token)
+    while len(verified_tokens) > VERIFIED_TOKENS_SIZE:
+        verified_tokens.popitem(last=False)
     return user
 
 
+def invalidate_user(username):
+    # call after changing or removing a user, their next request reads the record from mongo again
+    for token in [token for token, (user, _) in verified_tokens.items() if user["username"] == username]:
+        del verified_tokens[token]
+
+
 #  ------------------------------ ENDPOINTS ------------------------------
 
 
+async def save_upload(file: UploadFile, packet):
+    # stored once under its hash, hostserver streams that one copy to every host
+    # copied in chunks so memory stays flat regardless of file size, hashed and written in a thread
+    writer = await asyncio.to_thread(blobs.BlobWriter)
+    try:
+        while contents := await file.read(protocol.CHUNK_SIZE):
+            await asyncio.to_thread(writer.write, contents)
+    except BaseException:
+        await asyncio.to_thread(writer.abort)
+        raise
+    packet["sha256"] = await asyncio.to_thread(writer.commit)
+    packet["size"] = writer.size
+
+
+async def prune_blobs_periodically():
+    while True:
+        try:
+            await asyncio.to_thread(blobs.prune)
+        except OSError as e:
+            print(f"Failed to prune blobs: {e}")
+        await asyncio.sleep(blobs.BLOB_PRUNE_INTERVAL)
+
+
 @app.get("/hosts", response_class=HTMLResponse)
 async def show_all_hosts(request: Request, user: dict = Depends(get_current_user_from_token)):
     return templates.TemplateResponse(request=request, name="hosts.html")
@@ -262,26 +516,17 @@ async def show_host(request: Request, uuid: str, user: dict = Depends(get_curren
 
 @app.post("/host/{uuid}/submit")
 async def host_form_submit(request: Request, uuid: str, file: Optional[UploadFile] = File(None),
-                           user: dict = Depends(get_current_user_from_token)):
+                           stream: bool = False, user: dict = Depends(get_current_user_from_token)):
     form = await request.form()
-    print(uuid)
-    print(dict(form))
-    print(user)
 
     packet = dict(form)
     if file:
-        contents = await file.read()
-        with open(file.filename, "wb") as f:
-            f.write(contents)
-            # f.write(file.file)
+        await save_upload(file, packet)
         del packet["file"]
         packet["filename"] = file.filename
 
-    request_id = generate_request_id()
     packet["type"] = "cmd"
     packet["uuid"] = uuid
-    packet["request_id"] = request_id
-    await websocket.send(json.dumps(packet))
 
     async def download():
         return FileResponse(f"data/{uuid}/files/{data['filename']}", filename=data["filename"],
@@ -291,8 +536,31 @@ async def host_form_submit(request: Request, uuid: str, file: Optional[UploadFil
         "download": download,
     }
 
-    data = await request_message(request_id)
-    print(data)
+    if packet.get("cmd") == "command":
+        if stream:
+            # one json line per piece of output as the host produces it, the exit status last
+            # the first line carries the request_id, to cancel the command with
+            async def output():
+                parts = stream_request(packet, COMMAND_TIMEOUT)
+                done = False
+                try:
+                    async for part in parts:
+                        done = not part.get("more")
+                        yield json.dumps(part) + "\n"
+                except HTTPException as e:
+                    done = True
+                    yield json.dumps({"error": e.detail}) + "\n"
+                finally:
+                    await parts.aclose()
+                    if not done and "request_id" in packet:
+                        # the browser went away, nobody will read the rest so stop the command
+                        asyncio.create_task(stop_command(uuid, packet["request_id"]))
+
+            return StreamingResponse(output(), media_type="application/x-ndjson")
+        return await send_request(packet, COMMAND_TIMEOUT)
+
+    timeout = TRANSFER_TIMEOUT if packet.get("cmd") in TRANSFER_COMMANDS else REQUEST_TIMEOUT
+    data = await send_request(packet, timeout)
     if data.get("type", 0):
         resp = await func_map[data['type']]()
         return resp
@@ -300,6 +568,25 @@ async def host_form_submit(request: Request, uuid: str, file: Optional[UploadFil
     return data
 
 
+async def stop_command(uuid, request_id):
+    # best effort, a host that went offline has stopped the command already
+    try:
+        await cancel_command(uuid, request_id, None)
+    except HTTPException as e:
+        print(e.detail)
+
+
+@app.post("/host/{uuid}/cancel/{request_id}")
+async def cancel_command(uuid: str, request_id: str, user: dict = Depends(get_current_user_from_token)):
+    # kills a running shell command, its stream ends with status "cancelled"
+    packet = dict()
+    packet["type"] = "cmd"
+    packet["cmd"] = "cancel"
+    packet["uuid"] = uuid
+    packet["target"] = request_id
+    return await send_request(packet)
+
+
 @app.get("/groups", response_class=HTMLResponse)
 async def show_all_groups(request: Request, user: dict = Depends(get_current_user_from_token)):
     return templates.TemplateResponse(request=request, name="groups.html")
@@ -315,48 +602,64 @@ async def show_group(request: Request, uuid: str, user: dict = Depends(get_curre
     return templates.TemplateResponse(request=request, name="group.html", context={"uuid": uuid})
 
 
+async def request_host(uuid, packet, deadline):
+    # result of one host in a group command, failures are reported instead of raised
+    if uuid not in online_hosts:
+        return uuid, {"ack": "host offline"}
+    packet = dict(packet)
+    packet["uuid"] = uuid
+    try:
+        return uuid, await send_request(packet, deadline)
+    except HTTPException as e:
+        if e.status_code == status.HTTP_504_GATEWAY_TIMEOUT:
+            return uuid, {"ack": "timeout"}
+        return uuid, {"error": e.detail}
+    except Exception as e:
+        return uuid, {"error": str(e)}
+
+
+async def fan_out(uuids, packet, deadline):
+    # sends the packet to every host at once and yields (uuid, result) as each one answers
+    # a host that has not answered within deadline seconds is reported as timed out
+    tasks = [asyncio.create_task(request_host(_, packet, deadline)) for _ in uuids]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        # the client went away, stop waiting on the remaining hosts
+        for task in tasks:
+            task.cancel()
+
+
 @app.post("/group/{uuid}/submit")
 async def group_form_submit(request: Request, uuid: str, file: Optional[UploadFile] = File(None),
-                      user: dict = Depends(get_current_user_from_token)):
+                            deadline: Optional[float] = None, stream: bool = False,
+                            user: dict = Depends(get_current_user_from_token)):
     form = await request.form()
-    uuids = db["groups"].find_one({"uuid": uuid}, {"_id": 0, "hosts": 1})["hosts"]
+    uuids = (await database.find_one("groups", {"uuid": uuid}, {"_id": 0, "hosts": 1}))["hosts"]
     if not uuids:
         return []
 
     packet = dict(form)
     if file:
-        contents = await file.read()
-        with open(file.filename, "wb") as f:
-            f.write(contents)
+        await save_upload(file, packet)
         del packet["file"]
         packet["filename"] = file.filename
+    packet["type"] = "cmd"
+    if deadline is None:
+        deadline = TRANSFER_TIMEOUT if packet.get("cmd") in TRANSFER_COMMANDS else GROUP_DEADLINE
 
-    requests = dict()
-    for i in uuids:
-        request_id = generate_request_id()
-        packet["type"] = "cmd"
-        packet["uuid"] = i
-        packet["request_id"] = request_id
-        requests[request_id] = i
-        await websocket.send(json.dumps(packet))
-
-    # async def download():
-    #     return FileResponse(f"data/{uuid}/files/{data['filename']}", filename=data["filename"],
-    #                         media_type='application/octet-stream')
-    #
-    # func_map = {
-    #     "download": download,
-    # }
+    if stream:
+        # one json line per host, written as soon as that host answers
+        async def results():
+            async for i, result in fan_out(uuids, packet, deadline):
+                yield json.dumps({"uuid": i, "result": result}) + "\n"
 
-    data = dict()
-    for request_id in requests.keys():
-        temp = await request_message(request_id)
-        data[requests[request_id]] = temp
-    print(data)
+        return StreamingResponse(results(), media_type="application/x-ndjson")
 
-    # if data.get("type", 0):
-    #     resp = await func_map[data['type']]()
-    #     return resp
+    data = dict()
+    async for i, result in fan_out(uuids, packet, deadline):
+        data[i] = result
 
     return data
 
@@ -364,58 +667,46 @@ async def group_form_submit(request: Request, uuid: str, file: Optional[UploadFi
 #  ------------------------------ APIS ------------------------------
 
 
+@app.get("/metrics")
+async def get_metrics(request: Request):
+    # scraped by prometheus, which does not log in
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid metrics token")
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/api/all_hosts")
 async def get_all_hosts(user: dict = Depends(get_current_user_from_token)):
-    request_id = generate_request_id()
-    packet = dict()
-    packet["type"] = "hosts"
-    packet["request_id"] = request_id
-    await websocket.send(json.dumps(packet))
-    connected = await request_message(request_id)
-
-    res = db["hosts"].find({}, {"_id": 0})
+    res = await database.find("hosts", {}, {"_id": 0})
 
     all_hosts = []
-    for i in list(res):
+    for i in res:
         host = dict()
         host["uuid"] = i["uuid"]
         host["name"] = i.get("name", "...")
-        host["status"] = True if i["uuid"] in connected["hosts"] else False
+        host["status"] = True if i["uuid"] in online_hosts else False
         host["lastSeen"] = timeago.format(i["lastSeen"], datetime.datetime.now(datetime.UTC))
         host["timeCreated"] = i["timeCreated"]
         all_hosts.append(host)
-    res.close()
 
     return all_hosts
 
 
 @app.get("/api/active_hosts")
 async def get_active_hosts(user: dict = Depends(get_current_user_from_token)):
-    request_id = generate_request_id()
     packet = dict()
-    packet["type"] = "hosts"
-    packet["request_id"] = request_id
-    await websocket.send(json.dumps(packet))
-    connected = await request_message(request_id)
-
-    return connected
+    packet["hosts"] = list(online_hosts)
+    return packet
 
 
 @app.get("/api/host_info/{uuid}")
 async def get_host_info(uuid: str, user: dict = Depends(get_current_user_from_token)):
-    request_id = generate_request_id()
-    packet = dict()
-    packet["type"] = "hosts"
-    packet["request_id"] = request_id
-    await websocket.send(json.dumps(packet))
-    connected = await request_message(request_id)
-
-    res = db["hosts"].find_one({"uuid": uuid}, {"_id": 0})
+    res = await database.find_one("hosts", {"uuid": uuid}, {"_id": 0})
 
     host = dict()
     host["name"] = res.get("name", "...")
     host["uuid"] = res["uuid"]
-    host["status"] = True if uuid in connected["hosts"] else False
+    host["status"] = True if uuid in online_hosts else False
     host["lastSeen"] = timeago.format(res["lastSeen"], datetime.datetime.now(datetime.UTC))
     host["timeCreated"] = res["timeCreated"]
 
@@ -424,51 +715,234 @@ async def get_host_info(uuid: str, user: dict = Depends(get_current_user_from_to
 
 @app.post("/api/update_hostname")
 async def update_hostname(data: dict, user: dict = Depends(get_current_user_from_token)):
-    db["hosts"].update_one({"uuid": data["uuid"]}, {"$set": {"name": data["hostname"]}})
+    await database.update_one("hosts", {"uuid": data["uuid"]}, {"$set": {"name": data["hostname"]}})
+    publish("hostname", data["uuid"])
+
+
+def find_latest_snip(uuid):
+    # newest frame of a host as returned by snipstore.find, None if it has none
+    # the announced timestamp points straight at its segment, without one the log is searched from now
+    return snipstore.find(uuid, latest_snips.get(uuid))
+
+
+async def prerender(uuid):
+    frame = await asyncio.to_thread(find_latest_snip, uuid)
+    if frame:
+        await get_thumbnail(uuid, frame, "s")
+
+
+def render_thumbnails(uuid, frame):
+    # decodes the frame once and produces every scale from it
+    img = Image.open(io.BytesIO(snipstore.read_frame(uuid, frame))).convert("RGB")
+    renditions = dict()
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG")
+    renditions["m"] = buffer.getvalue()
+
+    x, y = img.size
+    buffer = io.BytesIO()
+    img.resize((x // 2, y // 2)).save(buffer, format="JPEG")
+    renditions["s"] = buffer.getvalue()
+
+    buffer = io.BytesIO()
+    img.resize((MOSAIC_TILE_WIDTH, max(1, y * MOSAIC_TILE_WIDTH // x))).save(buffer, format="JPEG")
+    renditions["t"] = buffer.getvalue()
+    return renditions
+
+
+async def get_thumbnail(uuid, frame, scale):
+    timestamp = frame[0]
+    key = (uuid, timestamp, scale)
+    if key in thumbnails:
+        thumbnails.move_to_end(key)
+        return thumbnails[key]
+
+    if (uuid, timestamp) not in rendering:
+        async def render():
+            try:
+                renditions = await asyncio.to_thread(render_thumbnails, uuid, frame)
+                for rendition, data in renditions.items():
+                    thumbnails[(uuid, timestamp, rendition)] = data
+                while len(thumbnails) > THUMBNAIL_CACHE_SIZE:
+                    thumbnails.popitem(last=False)
+                return renditions
+            finally:
+                del rendering[(uuid, timestamp)]
+
+        rendering[(uuid, timestamp)] = asyncio.create_task(render())
+    # shielded so a client going away does not cancel the render for everyone else
+    renditions = await asyncio.shield(rendering[(uuid, timestamp)])
+    return renditions[scale]
 
 
 @app.get("/api/latest_snip/{uuid}/{scale}")
-async def get_latest_snip(uuid: str, scale: str | None = None, user: dict = Depends(get_current_user_from_token)):
-    datafolder = f"data/{uuid}/snip"
-    files = glob.glob("*.png", root_dir=datafolder)
-    filename = max(files) if files else None
-    if not filename:
+async def get_latest_snip(request: Request, uuid: str, scale: str | None = None,
+                          user: dict = Depends(get_current_user_from_token)):
+    # the index is read in a thread like the frame itself
+    frame = await asyncio.to_thread(find_latest_snip, uuid)
+    if not frame:
         return FileResponse("static/blank.png", filename="blank.png", media_type="image/png")
-    filepath = os.path.join(datafolder, filename)
-    if scale == 'm':
-        Image.open(filepath).save(f"{filepath[:-4]}.jpg")
-        return FileResponse(os.path.join(datafolder, f"{filename[:-4]}.jpg"), filename=f"{filename[:-4]}.jpg",
-                            media_type="image/jpg")
-    elif scale == 's':
-        img = Image.open(filepath)
-        x, y = img.size
-        img.resize((x // 2, y // 2)).save(f"{filepath[:-4]}.jpg")
-        return FileResponse(os.path.join(datafolder, f"{filename[:-4]}.jpg"), filename=f"{filename[:-4]}.jpg",
-                            media_type="image/jpg")
-    return FileResponse(os.path.join(datafolder, filename), filename=filename, media_type="image/png")
+    timestamp, fmt = frame[0], frame[4]
+    if scale not in ('m', 's'):
+        content = await asyncio.to_thread(snipstore.read_frame, uuid, frame)
+        return Response(content=content, media_type=f"image/{fmt}",
+                        headers={"Content-Disposition": f'attachment; filename="{timestamp}.{fmt}"'})
+
+    # the page asks for the full frame by this name, with png in place of jpg
+    headers = {
+        "ETag": f'"{timestamp}-{scale}"',
+        "Last-Modified": formatdate(timestamp / 1000, usegmt=True),
+        "Content-Disposition": f'attachment; filename="{timestamp}.jpg"',
+        # browsers revalidate every time, unchanged thumbnails cost a 304
+        "Cache-Control": "no-cache",
+    }
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    if "if-none-match" not in request.headers and request.headers.get("if-modified-since"):
+        try:
+            since = parsedate_to_datetime(request.headers["if-modified-since"]).timestamp()
+            if timestamp // 1000 <= since:
+                return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        except (TypeError, ValueError):
+            pass
+
+    content = await get_thumbnail(uuid, frame, scale)
+    return Response(content=content, media_type="image/jpeg", headers=headers)
 
 
 @app.get("/api/snip/{uuid}/{filename}")
 async def get_snip(uuid: str, filename, user: dict = Depends(get_current_user_from_token)):
-    datafolder = f"data/{uuid}/snip"
-    if not os.path.exists(os.path.join(datafolder, filename)):
+    # filename is a timestamp in ms, any extension is ignored, the frame shown at that moment is returned
+    try:
+        timestamp = int(filename.split(".")[0])
+    except ValueError:
+        return FileResponse("static/blank.png", media_type="image/png")
+    frame = await asyncio.to_thread(snipstore.find, uuid, timestamp)
+    if frame is None:
         return FileResponse("static/blank.png", media_type="image/png")
-    return FileResponse(os.path.join(datafolder, filename), filename=filename, media_type=f"image/{filename[-3:]}")
+    content = await asyncio.to_thread(snipstore.read_frame, uuid, frame)
+    headers = {"Content-Disposition": f'attachment; filename="{frame[0]}.{frame[4]}"'}
+    if frame[0] == timestamp:
+        # a stored frame never changes
+        headers["Cache-Control"] = "max-age=86400, immutable"
+    return Response(content=content, media_type=f"image/{frame[4]}", headers=headers)
+
+
+@app.get("/api/snips/{uuid}")
+async def get_snip_timeline(uuid: str, start: int = 0, end: Optional[int] = None, limit: int = TIMELINE_LIMIT,
+                            user: dict = Depends(get_current_user_from_token)):
+    # timestamps of the stored frames between start and end in ms, oldest first, each one fetched from /api/snip
+    if limit < 0:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Limit must not be negative")
+    end = snipstore.now_ms() if end is None else end
+    timestamps = await asyncio.to_thread(snipstore.timestamps, uuid, start, end, min(limit, TIMELINE_LIMIT))
+    packet = dict()
+    packet["timestamps"] = timestamps
+    packet["retention"] = snipstore.RETENTION
+    return packet
 
 
-@app.get("/api/all_groups")
-async def get_all_groups(user: dict = Depends(get_current_user_from_token)):
-    request_id = generate_request_id()
+@app.post("/api/recording/{uuid}/{action}")
+async def set_recording(uuid: str, action: str, user: dict = Depends(get_current_user_from_token)):
+    # frames and input of a recording are kept past the snip retention, until the recording is deleted
+    # hostserver stops a recording after RECORDING_MAX_SECONDS if nobody does
+    if action not in ("start", "stop"):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Unknown action")
     packet = dict()
-    packet["type"] = "hosts"
-    packet["request_id"] = request_id
-    await websocket.send(json.dumps(packet))
-    connected = await request_message(request_id)
+    packet["type"] = "record"
+    packet["uuid"] = uuid
+    packet["action"] = action
+    packet["user"] = user["username"]
+    return await send_request(packet)
+
+
+@app.delete("/api/recording/{uuid}/{recording_id}")
+async def delete_recording(uuid: str, recording_id: str, user: dict = Depends(get_current_user_from_token)):
+    # its history goes with the next prune once it is older than the snip retention
+    packet = dict()
+    packet["type"] = "record"
+    packet["uuid"] = uuid
+    packet["action"] = "delete"
+    packet["id"] = recording_id
+    return await send_request(packet)
+
+
+@app.get("/api/recordings/{uuid}")
+async def get_recordings(uuid: str, user: dict = Depends(get_current_user_from_token)):
+    res = await database.find("recordings", {"uuid": uuid}, {"_id": 0})
+    return sorted(res, key=lambda _: _["start"], reverse=True)
+
+
+def next_frame(uuid, frames):
+    # the next frame of a replay with its bytes, None after the last one
+    frame = next(frames, None)
+    if frame is None:
+        return None
+    return frame, snipstore.read_frame(uuid, frame)
 
-    res = db["groups"].find({}, {"_id": 0})
+
+async def replay(uuid, start, end, speed):
+    # frames and relayed events between start and end in the order they happened, paced by their timestamps
+    events = await asyncio.to_thread(snipstore.read_events, uuid, start, end)
+    frames = snipstore.frames(uuid, start, end)
+    # the screen as it was at start, taken before it
+    first = await asyncio.to_thread(snipstore.find, uuid, start)
+    if first and first[0] < start:
+        upcoming = first, await asyncio.to_thread(snipstore.read_frame, uuid, first)
+    else:
+        upcoming = await asyncio.to_thread(next_frame, uuid, frames)
+
+    loop = asyncio.get_running_loop()
+    due = loop.time()
+    previous = start
+    i = 0
+    while upcoming is not None or i < len(events):
+        if upcoming is not None and (i == len(events) or upcoming[0][0] <= events[i][0]):
+            (timestamp, _, _, _, fmt), data = upcoming
+            timestamp = max(timestamp, start)
+            packet = dict()
+            packet["type"] = "frame"
+            packet["timestamp"] = timestamp
+            packet["format"] = fmt
+            packet["data"] = base64.b64encode(data).decode()
+            upcoming = await asyncio.to_thread(next_frame, uuid, frames)
+        else:
+            timestamp, kind, detail = events[i]
+            packet = dict()
+            packet["type"] = "event"
+            packet["timestamp"] = timestamp
+            packet["kind"] = kind
+            packet["detail"] = detail
+            i += 1
+        due += min((timestamp - previous) / 1000 / speed, REPLAY_MAX_GAP)
+        previous = timestamp
+        await asyncio.sleep(max(0, due - loop.time()))
+        yield json.dumps(packet) + "\n"
+
+    packet = dict()
+    packet["type"] = "end"
+    packet["timestamp"] = end
+    yield json.dumps(packet) + "\n"
+
+
+@app.get("/api/replay/{uuid}")
+async def get_replay(uuid: str, start: int, end: Optional[int] = None, speed: float = 1,
+                     user: dict = Depends(get_current_user_from_token)):
+    # newline delimited json of the frames and input between start and end in ms, speed 2 plays twice as fast
+    # seeking is a new request from a later start, a recording is replayed from its start to its end
+    if not 0 < speed <= REPLAY_MAX_SPEED:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Speed must be above 0 and at most {REPLAY_MAX_SPEED}")
+    end = snipstore.now_ms() if end is None else end
+    return StreamingResponse(replay(uuid, start, end, speed), media_type="application/x-ndjson")
+
+
+@app.get("/api/all_groups")
+async def get_all_groups(user: dict = Depends(get_current_user_from_token)):
+    res = await database.find("groups", {}, {"_id": 0})
 
     all_groups = []
-    for i in list(res):
+    for i in res:
         group = dict()
         group["uuid"] = i["uuid"]
         group["user"] = i["user"]
@@ -476,21 +950,19 @@ async def get_all_groups(user: dict = Depends(get_current_user_from_token)):
         group["hosts"] = i["hosts"]
         on = 0
         for uuid in i["hosts"]:
-            if uuid in connected["hosts"]:
+            if uuid in online_hosts:
                 on += 1
         group["status"] = {"on": on, "off": len(i["hosts"])-on}
         group["timeCreated"] = i["timeCreated"]
         all_groups.append(group)
-    res.close()
 
     return all_groups
 
 
 @app.post("/api/new_group")
 async def create_new_group(user: dict = Depends(get_current_user_from_token)):
-    res = db["groups"].find({}, {"_id": 0, "uuid": 1})
-    uuids = [_["uuid"] for _ in list(res)]
-    res.close()
+    res = await database.find("groups", {}, {"_id": 0, "uuid": 1})
+    uuids = [_["uuid"] for _ in res]
     group_id = str(uuid4())
     while group_id in uuids:
         group_id = str(uuid4())
@@ -503,34 +975,31 @@ async def create_new_group(user: dict = Depends(get_current_user_from_token)):
         "hosts": [],
         "timeCreated": now
     }
-    db["groups"].insert_one(document)
+    await database.insert_one("groups", document)
+    publish("group", group_id)
 
 
 @app.post("/api/update_groupname")
 async def update_groupname(data: dict, user: dict = Depends(get_current_user_from_token)):
-    db["groups"].update_one({"uuid": data["uuid"]}, {"$set": {"name": data["groupname"]}})
+    await database.update_one("groups", {"uuid": data["uuid"]}, {"$set": {"name": data["groupname"]}})
+    publish("group", data["uuid"])
 
 
 @app.post("/api/edit_group")
 async def edit_group(data: dict, user: dict = Depends(get_current_user_from_token)):
-    db["groups"].update_one({"uuid": data["uuid"]}, {"$set": {"hosts": data["hosts"]}})
+    await database.update_one("groups", {"uuid": data["uuid"]}, {"$set": {"hosts": data["hosts"]}})
+    publish("group", data["uuid"])
 
 
 @app.post("/api/delete_group")
 async def delete_group(data: dict, user: dict = Depends(get_current_user_from_token)):
-    db["groups"].delete_one({"uuid": data["uuid"]})
+    await database.delete_one("groups", {"uuid": data["uuid"]})
+    publish("group", data["uuid"])
 
 
 @app.get("/api/group_info/{uuid}")
 async def get_group_info(uuid: str, user: dict = Depends(get_current_user_from_token)):
-    request_id = generate_request_id()
-    packet = dict()
-    packet["type"] = "hosts"
-    packet["request_id"] = request_id
-    await websocket.send(json.dumps(packet))
-    connected = await request_message(request_id)
-
-    res = db["groups"].find_one({"uuid": uuid}, {"_id": 0})
+    res = await database.find_one("groups", {"uuid": uuid}, {"_id": 0})
 
     group = dict()
     group["uuid"] = res["uuid"]
@@ -539,7 +1008,7 @@ async def get_group_info(uuid: str, user: dict = Depends(get_current_user_from_t
     group["hosts"] = res["hosts"]
     on = 0
     for uuid in res["hosts"]:
-        if uuid in connected["hosts"]:
+        if uuid in online_hosts:
             on += 1
     group["status"] = {"on": on, "off": len(res["hosts"])-on}
     group["timeCreated"] = res["timeCreated"]
@@ -549,31 +1018,157 @@ async def get_group_info(uuid: str, user: dict = Depends(get_current_user_from_t
 
 @app.get("/api/group_host_info/{uuid}")
 async def get_group_host_info(uuid: str, user: dict = Depends(get_current_user_from_token)):
-    request_id = generate_request_id()
-    packet = dict()
-    packet["type"] = "hosts"
-    packet["request_id"] = request_id
-    await websocket.send(json.dumps(packet))
-    connected = await request_message(request_id)
-
-    uuids = db["groups"].find_one({"uuid": uuid}, {"_id": 0, "hosts": 1})["hosts"]
+    uuids = (await database.find_one("groups", {"uuid": uuid}, {"_id": 0, "hosts": 1}))["hosts"]
     if not uuids:
         return []
-    res = db["hosts"].find({"$or": [{"uuid": _} for _ in uuids]}, {"_id": 0})
+    res = await database.find("hosts", {"$or": [{"uuid": _} for _ in uuids]}, {"_id": 0})
 
     all_hosts = []
-    for i in list(res):
+    for i in res:
         host = dict()
         host["uuid"] = i["uuid"]
         host["name"] = i.get("name", "...")
-        host["status"] = True if i["uuid"] in connected["hosts"] else False
+        host["status"] = True if i["uuid"] in online_hosts else False
         host["lastSeen"] = timeago.format(i["lastSeen"], datetime.utcnow())
         host["timeCreated"] = i["timeCreated"]
         all_hosts.append(host)
-    res.close()
 
     return all_hosts
 
 
+@app.get("/api/group_mosaic/{uuid}")
+async def get_group_mosaic(uuid: str, since: int = 0, user: dict = Depends(get_current_user_from_token)):
+    # tiles of the group's hosts whose frame changed after version since, all of them when since is 0
+    # a 4 byte manifest length, the json manifest, then the jpeg tiles back to back at the offsets it lists
+    res = await database.find_one("groups", {"uuid": uuid}, {"_id": 0, "hosts": 1})
+    if res is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Group not found")
+    version = snip_version
+    uuids = [_ for _ in res["hosts"] if not since or snip_versions.get(_, 0) > since]
+    frames = await asyncio.to_thread(lambda: [(_, find_latest_snip(_)) for _ in uuids])
+    frames = [(host_id, frame) for host_id, frame in frames if frame]
+    # only frames nobody has looked at yet are rendered, the rest come from the thumbnail cache
+    tiles = await asyncio.gather(*(get_thumbnail(host_id, frame, "t") for host_id, frame in frames))
+
+    manifest = dict()
+    manifest["version"] = version
+    manifest["tiles"] = []
+    offset = 0
+    for (host_id, frame), tile in zip(frames, tiles):
+        manifest["tiles"].append({"uuid": host_id, "timestamp": frame[0], "offset": offset, "length": len(tile)})
+        offset += len(tile)
+    manifest = json.dumps(manifest).encode()
+    content = b"".join([struct.pack("!I", len(manifest)), manifest, *tiles])
+    return Response(content=content, media_type="application/octet-stream", headers={"Cache-Control": "no-store"})
+
+
+#  ------------------------------ LIVE ------------------------------
+
+
+async def accept_websocket(browser: WebSocket):
+    # browsers send the login cookie with the handshake, there is no other way to pass a token
+    scheme, token = get_authorization_scheme_param(browser.cookies.get("access_token"))
+    try:
+        if scheme.lower() != "bearer":
+            raise RequiresLogin
+        await get_user_from_token(token)
+    except RequiresLogin:
+        await browser.close(code=status.WS_1008_POLICY_VIOLATION)
+        return False
+    await browser.accept()
+    return True
+
+
+@app.websocket("/api/live")
+async def live(browser: WebSocket):
+    # pushes events to the dashboard as they happen, one shared source for every open tab
+    if not await accept_websocket(browser):
+        return
+    queue = asyncio.Queue(SUBSCRIBER_QUEUE_SIZE)
+    subscribers.add(queue)
+
+    async def send_events():
+        while True:
+            await browser.send_json(await queue.get())
+
+    async def receive():
+        # the browser says which hosts it shows and how closely
+        while True:
+            try:
+                data = json.loads(await browser.receive_text())
+            except json.JSONDecodeError:
+                continue
+            if data.get("type") != "watch":
+                continue
+            interval = WATCH_INTERVALS.get(data.get("level"))
+            previous = watching.get(queue, {})
+            watching[queue] = {uuid: interval for uuid in data.get("hosts", [])} if interval else {}
+            await update_capture(set(previous) | set(watching[queue]))
+
+    tasks = [asyncio.create_task(send_events()), asyncio.create_task(receive())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        subscribers.discard(queue)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # the endpoint may be cancelled while it cleans up, the hosts still have to slow down
+        asyncio.create_task(update_capture(watching.pop(queue, {})))
+
+
+@app.websocket("/host/{uuid}/input")
+async def host_input(browser: WebSocket, uuid: str):
+    # mouse and keyboard from the control page, batched by the browser and applied by the host in order
+    # the browser sends {"seq": n, "events": [...]} numbered from n on and gets back {"ack": n} for the last one applied
+    if not await accept_websocket(browser):
+        return
+
+    channel = str(uuid4())
+    input_channels[channel] = browser
+    # one link per host keeps batches in order
+    link = pools[cluster.ring.node_for(uuid)].link_for(uuid, "control")
+    try:
+        while True:
+            try:
+                data = json.loads(await browser.receive_text())
+            except json.JSONDecodeError:
+                continue
+            if not isinstance(data, dict):
+                await browser.send_json({"error": "invalid batch"})
+                continue
+            events, seq = data.get("events"), data.get("seq")
+            if not isinstance(events, list) or not all(protocol.valid_input(_) for _ in events):
+                await browser.send_json({"error": "invalid events"})
+                continue
+            if not isinstance(seq, int) or isinstance(seq, bool) or seq < 1:
+                await browser.send_json({"error": "invalid seq"})
+                continue
+            packet = dict()
+            packet["type"] = "input"
+            packet["uuid"] = uuid
+            packet["channel"] = channel
+            packet["seq"] = seq
+            packet["events"] = events
+            try:
+                await link.send(packet)
+            except hostlink.LinkUnavailable as e:
+                await browser.send_json({"error": str(e)})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        del input_channels[channel]
+        # lets the host forget the channel
+        packet = dict()
+        packet["type"] = "input"
+        packet["uuid"] = uuid
+        packet["channel"] = channel
+        packet["close"] = True
+        try:
+            await link.send(packet)
+        except hostlink.LinkUnavailable:
+            pass
+
+
 if __name__ == '__main__':
     uvicorn.run(app, host='0.0.0.0', port=8000)